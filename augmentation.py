@@ -0,0 +1,111 @@
+"""
+Color permutation augmentation of npz datasets that were generated with color masks, usage:
+def sample_func():
+    ...
+    frame, mask = grab_frame(cam_pos, cam_target, light_dir, frame_size, with_mask=True)
+    return frame, predicates, mask
+create_dataset(path, num_batches, batch_size, sample_func)
+dataset = load_recolored([path], num_variants=4)
+Every variant of a frame recolors its objects by a random permutation of the valid colors, both in the
+pixels (through the mask) and in the obj_color/subj_color fields of its predicates. A permutation maps true
+predicates to true and false ones to false, so the targets are kept as they are.
+"""
+
+from typing import Optional, Sequence
+
+import numpy as np
+import tensorflow as tf
+
+from batching import _list_files, _num_files
+from predicates import _FIELD_OFFSETS, ONE_HOT_SIZE, AtomColor
+from sampling import _VALID_COLORS
+
+NUM_COLORS = len(AtomColor)
+# the rgb channels every color is on in
+_COLOR_CHANNELS = np.array([AtomColor(c).to_rgba()[:3] for c in range(NUM_COLORS)], dtype=np.float32)
+_PERMUTED_COLORS = np.array(sorted(_VALID_COLORS), dtype=np.int32)
+# one-hot columns of the obj_color and subj_color fields
+_COLOR_COLUMNS = (int(_FIELD_OFFSETS[2]), int(_FIELD_OFFSETS[4]))
+
+
+def random_permutation(rng: tf.random.Generator) -> tf.Tensor:
+    # a permutation of all colors that shuffles the valid ones and keeps NO_COLOR and WHITE
+    shuffled = tf.gather(_PERMUTED_COLORS, tf.argsort(rng.uniform((len(_PERMUTED_COLORS),))))
+    return tf.tensor_scatter_nd_update(tf.range(NUM_COLORS), _PERMUTED_COLORS[:, None], shuffled)
+
+
+def recolor_frame(frame: tf.Tensor, mask: tf.Tensor, permutation: tf.Tensor) -> tf.Tensor:
+    """
+    Recolors the object pixels of a uint8 frame, the shading of a pixel is kept as the mean of the channels
+    its color is on in and the mean of those it is off in, which are assigned to the channels of the new color
+    """
+    pixels = tf.cast(frame, tf.float32)
+    mask = tf.cast(mask, tf.int32)
+    source = tf.gather(_COLOR_CHANNELS, mask)
+    target = tf.gather(_COLOR_CHANNELS, tf.gather(permutation, mask))
+
+    on = tf.reduce_sum(pixels * source, -1, keepdims=True) / tf.maximum(
+        tf.reduce_sum(source, -1, keepdims=True), 1.0
+    )
+    off = tf.reduce_sum(pixels * (1.0 - source), -1, keepdims=True) / tf.maximum(
+        tf.reduce_sum(1.0 - source, -1, keepdims=True), 1.0
+    )
+    recolored = target * on + (1.0 - target) * off
+    recolored = tf.where((mask > 0)[..., None], recolored, pixels)
+    return tf.cast(tf.clip_by_value(tf.round(recolored), 0.0, 255.0), tf.uint8)
+
+
+def recolor_predicates(predicates: tf.Tensor, permutation: tf.Tensor) -> tf.Tensor:
+    # column c of a color field moves to column permutation[c]
+    inverse = tf.math.invert_permutation(permutation)
+    columns = tf.range(ONE_HOT_SIZE)
+    for offset in _COLOR_COLUMNS:
+        columns = tf.tensor_scatter_nd_update(
+            columns, tf.range(offset, offset + NUM_COLORS)[:, None], offset + inverse
+        )
+    return tf.gather(predicates, columns, axis=-1)
+
+
+def _parse_masked_file(f):
+    data = np.load(f.numpy())
+    if "masks" not in data:
+        raise ValueError(f"{f.numpy().decode()} has no color masks")
+    return data["frames"], data["masks"], data["predicates"], data["targets"]
+
+
+def _load_masked_file(f):
+    return tf.py_function(_parse_masked_file, [f], [tf.uint8, tf.uint8, tf.float32, tf.float32])
+
+
+def _recolor(variant, frame, mask, predicates, targets, rng):
+    # the first variant of every frame is the original
+    permutation = tf.cond(variant > 0, lambda: random_permutation(rng), lambda: tf.range(NUM_COLORS))
+    return recolor_frame(frame, mask, permutation), recolor_predicates(predicates, permutation), targets
+
+
+def _pair(frame, predicates, targets):
+    return tf.data.Dataset.from_tensor_slices(
+        ((tf.repeat(frame[None], tf.shape(predicates)[0], axis=0), predicates), targets)
+    )
+
+
+def load_recolored(paths: Sequence[str], num_variants=4, seed: Optional[int] = None) -> tf.data.Dataset:
+    """
+    ((frame, predicate), target) elements of the datasets like batching.load_datasets, every frame appears
+    as `num_variants` consecutive variants with all of its predicates, the original and recolored ones
+    """
+    rng = (
+        tf.random.Generator.from_seed(seed)
+        if seed is not None
+        else tf.random.Generator.from_non_deterministic_state()
+    )
+    files = tf.data.Dataset.from_tensors(paths).flat_map(_list_files)
+    files = files.shuffle(sum(_num_files(path) for path in paths), seed=seed)
+
+    frames = files.flat_map(lambda f: tf.data.Dataset.from_tensor_slices(tuple(_load_masked_file(f))))
+    variants = frames.flat_map(
+        lambda *sample: tf.data.Dataset.zip(
+            (tf.data.Dataset.range(num_variants), tf.data.Dataset.from_tensors(sample).repeat())
+        )
+    )
+    return variants.map(lambda variant, sample: _recolor(variant, *sample, rng)).flat_map(_pair)
@@ -1,47 +1,279 @@
+import glob
+import json
+import multiprocessing
 import os
+import random
+import time
 
 import numpy as np
 import tensorflow as tf
 
 from tqdm import tqdm
 
+from predicates import ONE_HOT_SIZE, one_hot_from_ids
+from profiling import profile_call, timed, timer
+from storage import MANIFEST, build_index
 
-def _to_tensor(predicates):
+
+@timed("to_tensor")
+def _to_tensor(predicates, out=None):
+    # (one-hot predicates, targets) in random order, written into the `out` arrays when given
     indices = np.random.permutation(range(len(predicates)))
-    preds, p_values = zip(*[(p.to_one_hot(), np.array([p_value])) for p, p_value in predicates])
-    return np.stack(preds, axis=0)[indices], np.stack(p_values, axis=0)[indices]
+    if out is None:
+        out = np.empty((len(predicates), ONE_HOT_SIZE)), np.empty((len(predicates), 1))
+    preds, targets = out
+    preds[...] = one_hot_from_ids(np.array([predicates[i][0].to_id() for i in indices], dtype=np.int64))
+    targets[:, 0] = [predicates[i][1] for i in indices]
+    return preds, targets
+
+
+def _allocate_batch(num_samples, frame_shape, num_predicates, mask_shape=None):
+    batch = (
+        np.empty((num_samples, *frame_shape), dtype=np.uint8),
+        np.empty((num_samples, num_predicates, ONE_HOT_SIZE)),
+        np.empty((num_samples, num_predicates, 1)),
+    )
+    if mask_shape is not None:
+        batch += (np.empty((num_samples, *mask_shape), dtype=np.uint8),)
+    return batch
+
+
+def _generate_samples(num_samples, sample_func, seed=None, first_index=0):
+    """
+    Returns the (frames, predicates, targets) arrays of a batch, every sample is written directly into
+    its row of the arrays, which are allocated once the first sample shows their shapes.
+    With a seed, sample i (incl. the predicate order of _to_tensor) depends only on (seed, first_index + i).
+    A sample_func may return a color mask (see environment.grab_frame) as third value, it is stored as masks.
+    """
+    timer.count("samples", num_samples)
+    sample_func = timed("sample_func")(sample_func)
+    batch = None
+    for row in range(num_samples):
+        _seed_random(seed, first_index + row)
+        frame, predicates, *mask = sample_func()
+        if batch is None:
+            batch = _allocate_batch(
+                num_samples, np.shape(frame), len(predicates), np.shape(mask[0]) if mask else None
+            )
+        frames, preds, targets, *masks = batch
+        frames[row] = frame
+        if mask:
+            masks[0][row] = mask[0]
+        _to_tensor(predicates, out=(preds[row], targets[row]))
+    return batch
+
+
+def _create_samples(num_samples, sample_func, hide_output=True, seed=None, first_index=0):
+    from environment import get_session
+
+    get_session(hide_output)
+    if seed is None:
+        return _generate_samples(num_samples, sample_func, seed, first_index)
+
+    # the per-sample seeding must not leave the random state of the caller fixed
+    states = random.getstate(), np.random.get_state()
+    try:
+        return _generate_samples(num_samples, sample_func, seed, first_index)
+    finally:
+        random.setstate(states[0])
+        np.random.set_state(states[1])
+
+
+@timed("save")
+def _save_batch(file, batch):
+    # written to a temporary file first, so that a crash never leaves a truncated .npz behind
+    with open(file + ".tmp", "wb") as f:
+        np.savez(f, **dict(zip(("frames", "predicates", "targets", "masks"), batch)))
+    os.replace(file + ".tmp", file)
+
+
+def generate_sample(sample_func, seed, index, hide_output=True):
+    # sample `index` of the procedural dataset of (sample_func, seed): (frame, predicates, targets[, mask])
+    return tuple(column[0] for column in _create_samples(1, sample_func, hide_output, seed, index))
 
 
-def _create_samples(num_samples, sample_func, hide_output=True):
-    from environment import init_env, disconnect_env
-    from utils import HideOutput
+def _derive_seed(seed, index):
+    return int(np.random.SeedSequence([seed, index]).generate_state(1)[0])
+
+
+def _seed_random(seed, index):
+    # seeds the global random and np.random state, which the sample functions draw from
+    if seed is not None:
+        derived = _derive_seed(seed, index)
+        random.seed(derived)
+        np.random.seed(derived)
+
+
+_worker_state = {}
+
+
+def _init_worker(sample_func, hide_output):
+    from environment import get_session
+
+    _worker_state["sample_func"] = sample_func
+    _worker_state["hide_output"] = hide_output
+    # forked workers start with the random state of the parent, they must never draw the same samples
+    _seed_random(int(np.random.SeedSequence().entropy), os.getpid())
+    get_session(hide_output)
+    timer.reset()
+
+
+def _write_shard(file, index, batch_size, seed, sample_func, hide_output, profile_batch):
+    args = (batch_size, sample_func, hide_output, seed, index * batch_size)
+    if index == profile_batch:
+        batch = profile_call(file[: -len(".npz")] + ".prof", _create_samples, *args)
+    else:
+        batch = _create_samples(*args)
+    _save_batch(file, batch)
+
+
+def _create_shard(args):
+    # the stage times of the shard are sent back to the parent with the sample count
+    _write_shard(
+        *args, _worker_state["sample_func"], _worker_state["hide_output"], _worker_state["profile_batch"]
+    )
+    snapshot = timer.snapshot()
+    timer.reset()
+    return args[1], args[2], snapshot
+
 
-    with HideOutput(hide_output):
-        init_env()
-        raw_samples = [
-            (frame, *_to_tensor(predicates))
-            for frame, predicates in [sample_func() for i in range(num_samples)]
-        ]
-        disconnect_env()
+def _num_workers(num_workers, num_batches):
+    if num_workers == "auto":
+        num_workers = os.cpu_count() or 1
+    return max(0, min(num_workers, num_batches))
 
-    return raw_samples
 
+def _read_manifest(path):
+    file = os.path.join(path, MANIFEST)
+    if not os.path.exists(file):
+        return None
+    with open(file) as f:
+        return json.load(f)
 
-def create_dataset(path: str, num_batches: int, batch_size: int, sample_func, hide_output=True):
-    print(f"Generating {num_batches} * {batch_size} = {num_batches * batch_size} samples")
 
-    _order = int(np.log10(num_batches)) + 1
-    os.makedirs(path)
+def _write_manifest(path, manifest):
+    file = os.path.join(path, MANIFEST)
+    with open(file + ".tmp", "w") as f:
+        json.dump(manifest, f, indent=2)
+    os.replace(file + ".tmp", file)
 
-    for i in tqdm(range(num_batches)):
-        batch = _create_samples(batch_size, sample_func, hide_output)
-        frames, predicates, targets = zip(*batch)
-        np.savez(
-            path + f"/_{str(i).zfill(_order)}.npz",
-            frames=np.stack(frames, axis=0),
-            predicates=np.stack(predicates, axis=0),
-            targets=np.stack(targets, axis=0),
+
+def _sample_func_name(sample_func):
+    return getattr(sample_func, "__qualname__", type(sample_func).__name__)
+
+
+def _open_manifest(path, batch_size, sample_func, seed):
+    manifest = _read_manifest(path)
+    if manifest is None:
+        if glob.glob(path + "/*.npz"):
+            raise ValueError(f"{path} contains a dataset without {MANIFEST}, it can not be resumed")
+        os.makedirs(path, exist_ok=True)
+        manifest = {
+            "format": "npz",
+            "version": 1,
+            "batch_size": batch_size,
+            "seed": seed if seed is not None else int(np.random.SeedSequence().entropy),
+            "sample_func": _sample_func_name(sample_func),
+            "shards": [],
+        }
+        _write_manifest(path, manifest)
+        return manifest
+
+    if manifest.get("format") != "npz":
+        raise ValueError(f"{path} is not an npz dataset")
+    if manifest["batch_size"] != batch_size:
+        raise ValueError(f"{path} was generated with batch_size={manifest['batch_size']}, not {batch_size}")
+    if seed is not None and manifest["seed"] != seed:
+        raise ValueError(f"{path} was generated with seed={manifest['seed']}, not {seed}")
+    if manifest["sample_func"] != _sample_func_name(sample_func):
+        raise ValueError(
+            f"{path} was generated with sample_func={manifest['sample_func']},"
+            f" not {_sample_func_name(sample_func)}"
         )
+    return manifest
+
+
+def create_dataset(
+    path: str,
+    num_batches: int,
+    batch_size: int,
+    sample_func,
+    hide_output=True,
+    num_workers=0,
+    seed=None,
+    profile_batch=None,
+    append=False,
+    index=True,
+):
+    """
+    Generates `num_batches` npz files of `batch_size` samples, optionally in `num_workers` processes.
+    path/manifest.json records the parameters, the seed and every completed shard, so an interrupted run
+    continues with the missing shards when it is called again, append=True fills the missing shards
+    and adds `num_batches` more.
+    Sample i of shard k is seeded from (seed, k * batch_size + i), a seed is drawn and recorded when none
+    is given, so streaming.VirtualDataset.from_dataset can regenerate any sample on its own.
+    The time spent per stage (reset_env, create_shape, render, labeling, to_tensor, save, ...) is shown
+    per sample in the progress bar and written to path/profile.json. The batch with index `profile_batch`
+    is additionally run under cProfile, its stats are dumped next to its file as .prof.
+    index=True extends the predicate index of the directory for storage.load_filtered.
+    """
+    manifest = _open_manifest(path, batch_size, sample_func, seed)
+    seed = manifest["seed"]
+    done = {shard["index"] for shard in manifest["shards"]}
+    first = max(done) + 1 if append and done else 0
+    # shards of an interrupted run with workers finish out of order, the holes are filled before appending
+    pending = [i for i in range(first) if i not in done]
+    pending += [i for i in range(first, first + num_batches) if i not in done]
+
+    print(
+        f"Generating {len(pending)} * {batch_size} = {len(pending) * batch_size} samples"
+        f" ({len(done)} of the batches are already done)"
+    )
+    if not pending:
+        return
+
+    _order = max(4, len(str(pending[-1])))
+    files = {i: f"_{str(i).zfill(_order)}.npz" for i in pending}
+    shards = [(os.path.join(path, files[i]), i, batch_size, seed) for i in pending]
+    num_batches = len(shards)
+    num_workers = _num_workers(num_workers, num_batches)
+    _worker_state["profile_batch"] = profile_batch
+    timer.reset()
+    start = time.perf_counter()
+
+    with tqdm(total=num_batches) as progress:
+
+        def _update(index, num_samples):
+            manifest["shards"].append(
+                {
+                    "index": index,
+                    "file": files[index],
+                    "samples": num_samples,
+                    "first_sample": index * batch_size,
+                }
+            )
+            _write_manifest(path, manifest)
+            progress.update()
+            progress.set_postfix(
+                samples_per_sec=f"{progress.n * num_samples / (time.perf_counter() - start):.1f}",
+                **timer.postfix(progress.n * num_samples),
+            )
+
+        if num_workers:
+            ctx = multiprocessing.get_context("fork")
+            with ctx.Pool(num_workers, initializer=_init_worker, initargs=(sample_func, hide_output)) as pool:
+                for index, num_samples, snapshot in pool.imap_unordered(_create_shard, shards):
+                    timer.merge(snapshot)
+                    _update(index, num_samples)
+        else:
+            for shard in shards:
+                _write_shard(*shard, sample_func, hide_output, profile_batch)
+                _update(shard[1], batch_size)
+
+    # with workers the stage times add up over processes, so they can exceed the elapsed time
+    timer.save(path + "/profile.json", num_batches * batch_size, time.perf_counter() - start)
+    if index:
+        build_index(path)
 
 
 def _parse_files(f):
@@ -52,8 +284,12 @@ def _parse_files(f):
     return frames, predicates, targets
 
 
+def _load_file(f):
+    return tf.py_function(_parse_files, [f], [tf.float32, tf.float32, tf.float32])
+
+
 def _process(f):
-    frames, predicates, targets = tf.py_function(_parse_files, [f], [tf.float32, tf.float32, tf.float32])
+    frames, predicates, targets = _load_file(f)
     return tf.data.Dataset.from_tensor_slices(
         (
             (
@@ -73,11 +309,45 @@ def load_as_tf_dataset(path):
     return _list_files(path).flat_map(_process)
 
 
+def _num_files(path):
+    manifest = _read_manifest(path)
+    if manifest is not None and manifest.get("format") == "npz":
+        return len(manifest["shards"])
+    return len(tf.io.gfile.glob(path + "/*.npz"))
+
+
 def load_datasets(paths):
     files = tf.data.Dataset.from_tensors(paths).flat_map(_list_files)
-    num_files = len(list(files))
+    num_files = sum(_num_files(path) for path in paths)
     print(f"Datasets contain {num_files} files in total.")
     files = files.shuffle(num_files)
 
     return files.flat_map(_process)
 
+
+def _pair_frames(frames, predicates, targets, gather=True):
+    frame_index = tf.repeat(tf.range(tf.shape(frames)[0]), tf.shape(targets)[1])
+    predicates = tf.reshape(predicates, (-1, tf.shape(predicates)[-1]))
+    targets = tf.reshape(targets, (-1, tf.shape(targets)[-1]))
+
+    if gather:
+        return (tf.gather(frames, frame_index), predicates), targets
+    return (frames, frame_index, predicates), targets
+
+
+def _process_grouped(f, frames_per_batch, shuffle_buffer):
+    samples = tf.data.Dataset.from_tensor_slices(tuple(_load_file(f)))
+    if shuffle_buffer:
+        samples = samples.shuffle(shuffle_buffer)
+    return samples.batch(frames_per_batch)
+
+
+def load_grouped(paths, frames_per_batch, gather=True, shuffle_buffer=0):
+    # already batched by frames, each batch holds all predicates of `frames_per_batch` frames of one file
+    # gather=True: ((frames, predicates), targets) with frames gathered per predicate only at batch time
+    # gather=False: ((unique frames, frame index, predicates), targets) for network.build_grouped_model
+    files = tf.data.Dataset.from_tensors(paths).flat_map(_list_files)
+
+    return files.flat_map(lambda f: _process_grouped(f, frames_per_batch, shuffle_buffer)).map(
+        lambda frames, predicates, targets: _pair_frames(frames, predicates, targets, gather)
+    )
@@ -0,0 +1,316 @@
+"""
+Benchmarks of the generation, labeling, loading and inference hot paths, usage:
+python benchmark.py --save benchmarks.json         # store the baselines
+python benchmark.py --compare benchmarks.json      # fail on regressions beyond --tolerance
+python benchmark.py --renderer tiny --only labeling predicates
+Metrics ending with _per_sec are better when higher, the others (ms_per_*) when lower.
+"""
+
+import argparse
+import json
+import os
+import platform
+import sys
+import tempfile
+import time
+from functools import partial
+
+import numpy as np
+
+BENCHMARKS = {}
+
+
+def benchmark(func):
+    BENCHMARKS[func.__name__] = func
+    return func
+
+
+def _best_time(func, min_time, repeat=5):
+    # best mean seconds per call over `repeat` runs, each run calls func often enough to last `min_time`
+    start = time.perf_counter()
+    func()
+    number = max(1, int(min_time / max(time.perf_counter() - start, 1e-9)))
+    best = float("inf")
+    for _ in range(repeat):
+        start = time.perf_counter()
+        for _ in range(number):
+            func()
+        best = min(best, (time.perf_counter() - start) / number)
+    return best
+
+
+def _min_time(quick):
+    return 0.02 if quick else 0.2
+
+
+def _sample_scene(num_objects=2):
+    import sampling
+
+    return sampling.sample_layouts(
+        1, num_objects, (0, 0, 1.0), (4.0, 4.0, 0.0), 2 * np.pi, 2.0, min_distance=2.0
+    ).to_objects(0)
+
+
+def _render_sample(frame_size):
+    # the two-object on-table sample of the notebooks
+    from environment import create_shape, grab_frame, reset_env
+    import sampling
+
+    objects = _sample_scene()
+    predicates = [p for o in objects for p in sampling.get_on_table_relation(o, (4.0, 4.0, 0.0), False)]
+    predicates += sampling.get_false_predicates(predicates, 4)
+
+    reset_env()
+    for o in objects:
+        create_shape(o.obj_type, o.color, o.position, o.orientation, o.size)
+    frame = grab_frame(
+        cam_pos=(0, -10, 12), cam_target=(0, -1, 0), light_dir=(-6, 1, 10), frame_size=frame_size
+    )
+    return frame, predicates
+
+
+@benchmark
+def create_dataset(quick):
+    from batching import create_dataset
+
+    num_batches, batch_size = (2, 8) if quick else (4, 32)
+    results = {}
+    for size in (64, 128):
+        sample_func = partial(_render_sample, (size, size))
+        sample_func()
+        with tempfile.TemporaryDirectory() as tmp:
+            start = time.perf_counter()
+            create_dataset(tmp + "/ds", num_batches, batch_size, sample_func)
+            elapsed = time.perf_counter() - start
+        results[f"create_dataset.{size}x{size}.samples_per_sec"] = num_batches * batch_size / elapsed
+    return results
+
+
+@benchmark
+def environment(quick):
+    from environment import create_shape, get_session, grab_frame, reset_env
+    from predicates import AtomColor, AtomObject
+
+    get_session()
+    min_time = _min_time(quick)
+    objects = _sample_scene(8)
+
+    def _create_shapes():
+        reset_env()
+        for o in objects:
+            create_shape(o.obj_type, o.color, o.position, o.orientation, o.size)
+
+    results = {
+        "environment.reset_env.ms_per_call": _best_time(reset_env, min_time) * 1e3,
+        "environment.create_shape.ms_per_call": (
+            (_best_time(_create_shapes, min_time) - _best_time(reset_env, min_time)) / len(objects) * 1e3
+        ),
+    }
+    create_shape(AtomObject.CUBE, AtomColor.RED, (0, 0, 1.0), (0, 0, 0))
+    for size in (64, 128):
+        grab = partial(grab_frame, (0, -10, 12), (0, -1, 0), (-6, 1, 10), (size, size))
+        results[f"environment.grab_frame.{size}x{size}.ms_per_call"] = _best_time(grab, min_time) * 1e3
+    return results
+
+
+@benchmark
+def labeling(quick):
+    import sampling
+    from labeling import label_scenes
+
+    num_scenes = 10 if quick else 50
+    bounds = (10.0, 10.0, 0.0)
+    results = {}
+    for num_objects in (2, 10, 30, 100):
+        scenes = sampling.sample_layouts(
+            num_scenes, num_objects, (0, 0, 1.0), bounds, 2 * np.pi, 1.0, min_distance=1.0
+        )
+        objects = [scenes.to_objects(i) for i in range(num_scenes)]
+
+        def _per_object():
+            for scene in objects:
+                [p for o in scene for p in sampling.get_on_table_relation(o, bounds)]
+                sampling.get_near_relation(scene)
+                sampling.get_on_relation(scene)
+
+        for name, func in (
+            ("per_object", _per_object),
+            ("batch", partial(label_scenes, scenes, bounds)),
+            ("batch_sparse", partial(label_scenes, scenes, bounds, sparse=True)),
+        ):
+            per_call = _best_time(func, _min_time(quick))
+            results[f"labeling.{name}.objects_{num_objects}.scenes_per_sec"] = num_scenes / per_call
+    return results
+
+
+@benchmark
+def predicates(quick):
+    from predicates import NUM_PREDICATES, AtomPredicate
+
+    count = 1000
+    ids = np.random.randint(NUM_PREDICATES, size=count)
+    preds = [AtomPredicate.from_id(int(i)) for i in ids]
+    one_hots = [p.to_one_hot() for p in preds]
+
+    def _to_one_hot():
+        for p in preds:
+            p.to_one_hot()
+
+    def _from_one_hot():
+        for v in one_hots:
+            AtomPredicate.from_one_hot(v)
+
+    return {
+        "predicates.to_one_hot.ops_per_sec": count / _best_time(_to_one_hot, _min_time(quick)),
+        "predicates.from_one_hot.ops_per_sec": count / _best_time(_from_one_hot, _min_time(quick)),
+    }
+
+
+def _write_npz_dataset(path, num_files, batch_size, frame_size=(64, 64), num_predicates=8):
+    from predicates import NUM_PREDICATES, one_hot_from_ids
+
+    os.makedirs(path)
+    for i in range(num_files):
+        np.savez(
+            path + f"/_{i}.npz",
+            frames=np.random.randint(256, size=(batch_size, *frame_size, 3), dtype=np.uint8),
+            predicates=one_hot_from_ids(np.random.randint(NUM_PREDICATES, size=(batch_size, num_predicates))),
+            targets=np.random.random_sample((batch_size, num_predicates, 1)),
+        )
+
+
+def _elements_per_sec(dataset, batch_size=256):
+    start = time.perf_counter()
+    count = sum(int(tf_batch[1].shape[0]) for tf_batch in dataset.batch(batch_size))
+    return count / (time.perf_counter() - start)
+
+
+@benchmark
+def loading(quick):
+    from batching import load_datasets
+    from storage import convert_npz_dataset, load_native
+
+    num_files = 4 if quick else 16
+    with tempfile.TemporaryDirectory() as tmp:
+        _write_npz_dataset(tmp + "/npz", num_files, 64)
+        convert_npz_dataset(tmp + "/npz", tmp + "/columnar")
+        return {
+            "loading.load_datasets.elements_per_sec": _elements_per_sec(load_datasets([tmp + "/npz"])),
+            "loading.load_native.elements_per_sec": _elements_per_sec(load_native([tmp + "/columnar"])),
+        }
+
+
+@benchmark
+def evaluation(quick):
+    import sampling
+    from inference import ProbeScorer
+    from network import build_model
+
+    model = build_model((64, 64))
+    frames = np.random.randint(256, size=(32, 64, 64, 3), dtype=np.uint8)
+    min_time = _min_time(quick)
+    probe_sets = [
+        sampling.get_on_table_probes(add_positional=False),
+        sampling.get_on_table_probes(),
+        sampling.get_near_probes(),
+    ]
+    probe_sets.append(np.vstack(probe_sets[1:]))
+
+    results = {}
+    for probes in probe_sets:
+        count = len(probes)
+        scorer = ProbeScorer(model, probes)
+        results[f"evaluation.probes_{count}.ms_per_frame"] = (
+            _best_time(partial(scorer.score_frame, frames[0]), min_time) * 1e3
+        )
+        results[f"evaluation.probes_{count}.batched.ms_per_frame"] = (
+            _best_time(partial(scorer.score, frames), min_time) / len(frames) * 1e3
+        )
+    return results
+
+
+def _environment_info(renderer):
+    import pybullet
+    import tensorflow as tf
+
+    return {
+        "platform": platform.platform(),
+        "python": platform.python_version(),
+        "cpu_count": os.cpu_count(),
+        "numpy": np.__version__,
+        "tensorflow": tf.__version__,
+        "pybullet": pybullet.getAPIVersion(),
+        "renderer": renderer,
+    }
+
+
+def run(names, quick=False, renderer="egl"):
+    from environment import get_session
+
+    get_session(load_egl=renderer == "egl")
+    np.random.seed(0)
+    metrics = {}
+    for name in names:
+        print(f"Running {name}...")
+        metrics.update(BENCHMARKS[name](quick))
+    return {"environment": _environment_info(renderer), "metrics": metrics}
+
+
+def _higher_is_better(metric):
+    return metric.endswith("_per_sec")
+
+
+def compare(results, baselines, tolerance=0.3):
+    """
+    Prints the relative change of every metric against the baselines and returns the regressed metrics,
+    those worse by more than `tolerance`
+    """
+    regressions = []
+    for metric, value in results["metrics"].items():
+        baseline = baselines["metrics"].get(metric)
+        if baseline is None:
+            print(f"{metric:60s} {value:12.3f}   (no baseline)")
+            continue
+
+        change = value / baseline - 1.0 if baseline else 0.0
+        worse = -change if _higher_is_better(metric) else change
+        flag = "REGRESSION" if worse > tolerance else ""
+        print(f"{metric:60s} {value:12.3f} {baseline:12.3f} {change:+8.1%} {flag}")
+        if flag:
+            regressions.append(metric)
+
+    if baselines["environment"] != results["environment"]:
+        print(f"Note: the baselines were measured in a different environment: {baselines['environment']}")
+    return regressions
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(
+        description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter
+    )
+    parser.add_argument("--only", nargs="+", choices=list(BENCHMARKS), default=list(BENCHMARKS))
+    parser.add_argument("--quick", action="store_true", help="fewer repetitions, for smoke tests")
+    parser.add_argument("--renderer", choices=("egl", "tiny"), default="egl")
+    parser.add_argument("--save", help="write the results as baselines to this JSON file")
+    parser.add_argument("--compare", help="compare the results against the baselines of this JSON file")
+    parser.add_argument("--tolerance", type=float, default=0.3)
+    args = parser.parse_args(argv)
+
+    results = run(args.only, args.quick, args.renderer)
+
+    if args.save:
+        with open(args.save, "w") as f:
+            json.dump(results, f, indent=2)
+
+    if args.compare:
+        with open(args.compare) as f:
+            regressions = compare(results, json.load(f), args.tolerance)
+        return 1 if regressions else 0
+
+    for metric, value in results["metrics"].items():
+        print(f"{metric:60s} {value:12.3f}")
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
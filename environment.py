@@ -1,12 +1,24 @@
+from collections import defaultdict
+from dataclasses import dataclass
+from functools import lru_cache
+from typing import Dict, Sequence, Tuple
+import atexit
+import os
 import pkgutil
 
+import numpy as np
 import pybullet as pb
 import pybullet_data
 
 from predicates import AtomColor, AtomObject
+from profiling import timed, timer
+from sampling import ObjectOnTable
 
 
 def init_env(load_egl=True, mode=pb.DIRECT):
+    _invalidate_scene()
+    shape_cache.clear()
+    body_colors.clear()
     client = pb.connect(mode)
     pb.setAdditionalSearchPath(pybullet_data.getDataPath())
 
@@ -17,7 +29,11 @@ def init_env(load_egl=True, mode=pb.DIRECT):
     return client
 
 
+@timed("reset_env")
 def reset_env():
+    _invalidate_scene()
+    shape_cache.clear()
+    body_colors.clear()
     pb.resetSimulation()
     pb.configureDebugVisualizer(pb.COV_ENABLE_GUI, 1)
     pb.setGravity(0, 0, -9.8)
@@ -27,11 +43,71 @@ def reset_env():
 
 
 def disconnect_env():
+    _invalidate_scene()
+    shape_cache.clear()
+    body_colors.clear()
     pb.disconnect()
 
 
-def get_camera_transforms(position, target):
-    projectionMatrix = pb.computeProjectionMatrixFOV(fov=45.0, aspect=1.0, nearVal=0.1, farVal=100.0)
+class Session:
+    """
+    A pybullet connection (with the EGL plugin) that is kept alive across batches, usage:
+    with Session() as session:
+        ...
+    """
+
+    def __init__(self, load_egl=True, mode=pb.DIRECT, hide_output=True):
+        self.load_egl = load_egl
+        self.mode = mode
+        self.hide_output = hide_output
+        self.client = None
+        self.pid = None
+
+    def is_alive(self):
+        return self.client is not None and self.pid == os.getpid() and bool(pb.isConnected(self.client))
+
+    def connect(self):
+        from utils import HideOutput
+
+        if self.client is not None and self.pid != os.getpid() and pb.isConnected(self.client):
+            # connection inherited from a forked parent, it has to be released before connecting again
+            pb.disconnect(self.client)
+        self.client = None
+
+        with HideOutput(self.hide_output):
+            self.client = init_env(self.load_egl, self.mode)
+        self.pid = os.getpid()
+        return self
+
+    def ensure(self):
+        return self if self.is_alive() else self.connect()
+
+    def close(self):
+        if self.is_alive():
+            disconnect_env()
+        self.client = None
+
+    def __enter__(self):
+        return self.ensure()
+
+    def __exit__(self, exc_type, exc_val, exc_tb):
+        self.close()
+
+
+_session = None
+
+
+def get_session(hide_output=True, load_egl=True) -> Session:
+    # the arguments only apply to the first call, which creates the session
+    global _session
+    if _session is None:
+        _session = Session(load_egl=load_egl, hide_output=hide_output)
+        atexit.register(_session.close)
+    return _session.ensure()
+
+
+def get_camera_transforms(position, target, fov=45.0, near=0.1, far=100.0):
+    projectionMatrix = pb.computeProjectionMatrixFOV(fov=fov, aspect=1.0, nearVal=near, farVal=far)
 
     viewMatrix = pb.computeViewMatrix(
         cameraEyePosition=position, cameraTargetPosition=target, cameraUpVector=[0, 0, 1]
@@ -39,11 +115,127 @@ def get_camera_transforms(position, target):
     return viewMatrix, projectionMatrix
 
 
-def grab_frame(cam_pos, cam_target, light_dir, frame_size):
-    cam_view_m, cam_proj_m = get_camera_transforms(cam_pos, cam_target)
-    _, _, rgbImg, _, _ = pb.getCameraImage(*frame_size, cam_view_m, cam_proj_m, lightDirection=light_dir)
+# bounded, sample functions may randomize the camera for every frame
+@lru_cache(maxsize=1024)
+def _cached_camera_transforms(position: tuple, target: tuple, fov=45.0, near=0.1, far=100.0):
+    return get_camera_transforms(position, target, fov, near, far)
+
+
+def grab_frame(cam_pos, cam_target, light_dir, frame_size, out=None, with_mask=False):
+    # the rgb channels are a view of the rendered rgba image, or are copied into `out` when it is given
+    # with_mask=True returns (frame, color mask) with the AtomColor of the object seen at every pixel
+    cam_view_m, cam_proj_m = _cached_camera_transforms(tuple(cam_pos), tuple(cam_target))
+    flags = 0 if with_mask else pb.ER_NO_SEGMENTATION_MASK
+    with timer.stage("render"):
+        _, _, rgbImg, _, segImg = pb.getCameraImage(
+            *frame_size, cam_view_m, cam_proj_m, lightDirection=light_dir, flags=flags
+        )
+
+    frame = rgbImg[..., :3]
+    if out is not None:
+        out[...] = frame
+        frame = out
+    if with_mask:
+        return frame, color_mask(segImg)
+    return frame
+
+
+def color_mask(segmentation: np.array) -> np.array:
+    # body ids of a segmentation buffer to AtomColor values, NO_COLOR for the fixtures and the background
+    table = np.zeros(max(body_colors, default=0) + 2, dtype=np.uint8)
+    for body, color in body_colors.items():
+        table[body] = color
+    segmentation = np.asarray(segmentation)
+    return table[np.where((segmentation >= 0) & (segmentation < len(table)), segmentation, -1)]
+
+
+@dataclass(frozen=True)
+class CameraRig:
+    position: Tuple[float, float, float]
+    target: Tuple[float, float, float]
+    light_dir: Tuple[float, float, float] = (-6, 1, 10)
+    fov: float = 45.0
+    near: float = 0.1
+    far: float = 100.0
+
+    @property
+    def transforms(self):
+        return _cached_camera_transforms(
+            tuple(self.position), tuple(self.target), self.fov, self.near, self.far
+        )
+
+    def linear_depth(self, z_buffer: np.array) -> np.array:
+        return self.far * self.near / (self.far - (self.far - self.near) * z_buffer)
+
+
+BUFFERS = ("rgb", "depth", "segmentation")
+
+
+def capture(rigs: Sequence[CameraRig], frame_size, buffers=("rgb",)) -> Dict[str, np.array]:
+    """
+    Renders every rig once and returns the requested buffers stacked over views:
+    rgb (views, h, w, 3) uint8, depth (views, h, w) float32 in world units,
+    segmentation (views, h, w) int32 body ids
+    """
+    unknown = set(buffers) - set(BUFFERS)
+    if unknown:
+        raise ValueError(f"Unsupported buffers: {unknown}")
+
+    width, height = frame_size
+    flags = 0 if "segmentation" in buffers else pb.ER_NO_SEGMENTATION_MASK
+    views = {b: [] for b in buffers}
+
+    for rig in rigs:
+        cam_view_m, cam_proj_m = rig.transforms
+        with timer.stage("render"):
+            _, _, rgbImg, depthImg, segImg = pb.getCameraImage(
+                width, height, cam_view_m, cam_proj_m, lightDirection=rig.light_dir, flags=flags
+            )
+        if "rgb" in views:
+            views["rgb"].append(np.reshape(rgbImg, (height, width, 4))[..., :3].astype(np.uint8))
+        if "depth" in views:
+            views["depth"].append(rig.linear_depth(np.reshape(depthImg, (height, width))).astype(np.float32))
+        if "segmentation" in views:
+            views["segmentation"].append(np.reshape(segImg, (height, width)).astype(np.int32))
 
-    return rgbImg[..., :3]
+    return {b: np.stack(frames, axis=0) for b, frames in views.items()}
+
+
+# AtomColor of the bodies created by create_shape, for the color masks of grab_frame
+body_colors: Dict[int, AtomColor] = {}
+
+
+class ShapeCache:
+    """
+    Visual and collision shape handles of the connected client, they are dropped together with the simulation.
+    """
+
+    def __init__(self):
+        self.shapes = {}
+        self.hits = 0
+        self.misses = 0
+
+    def get(self, key, create_func):
+        shape_id = self.shapes.get(key)
+        if shape_id is None:
+            self.misses += 1
+            shape_id = self.shapes[key] = create_func()
+        else:
+            self.hits += 1
+        return shape_id
+
+    def clear(self):
+        self.shapes.clear()
+
+    def stats(self):
+        return {"hits": self.hits, "misses": self.misses, "size": len(self.shapes)}
+
+
+shape_cache = ShapeCache()
+
+
+def _key(value):
+    return tuple(value) if isinstance(value, (list, tuple)) else value
 
 
 def _create_shape(
@@ -55,15 +247,31 @@ def _create_shape(
     if isinstance(shape_type, str):
         if not mesh_scale:
             mesh_scale = [1, 1, 1]
-        vId = pb.createVisualShape(
-            shapeType=pb.GEOM_MESH, fileName=shape_type, meshScale=mesh_scale, rgbaColor=color
+        geometry = ("mesh", shape_type, _key(mesh_scale))
+        vId = shape_cache.get(
+            ("visual", *geometry, _key(color)),
+            lambda: pb.createVisualShape(
+                shapeType=pb.GEOM_MESH, fileName=shape_type, meshScale=mesh_scale, rgbaColor=color
+            ),
+        )
+        cId = shape_cache.get(
+            ("collision", *geometry),
+            lambda: pb.createCollisionShape(
+                shapeType=pb.GEOM_MESH, fileName=shape_type, meshScale=mesh_scale
+            ),
         )
-        cId = pb.createCollisionShape(shapeType=pb.GEOM_MESH, fileName=shape_type, meshScale=mesh_scale)
     else:
-        vId = pb.createVisualShape(
-            shapeType=shape_type, halfExtents=half_extends, radius=radius, rgbaColor=color
+        geometry = (shape_type, _key(half_extends), radius)
+        vId = shape_cache.get(
+            ("visual", *geometry, _key(color)),
+            lambda: pb.createVisualShape(
+                shapeType=shape_type, halfExtents=half_extends, radius=radius, rgbaColor=color
+            ),
+        )
+        cId = shape_cache.get(
+            ("collision", *geometry),
+            lambda: pb.createCollisionShape(shapeType=shape_type, halfExtents=half_extends, radius=radius),
         )
-        cId = pb.createCollisionShape(shapeType=shape_type, halfExtents=half_extends, radius=radius)
     return pb.createMultiBody(
         baseMass=mass,
         baseCollisionShapeIndex=cId,
@@ -73,7 +281,14 @@ def _create_shape(
     )
 
 
+@timed("create_shape")
 def create_shape(obj: AtomObject, color: AtomColor, position, orientation, size=2.0):
+    body = _create_object_shape(obj, color, position, orientation, size)
+    body_colors[body] = color
+    return body
+
+
+def _create_object_shape(obj: AtomObject, color: AtomColor, position, orientation, size):
     if obj == AtomObject.CUBE:
         return _create_shape(
             pb.GEOM_BOX,
@@ -98,3 +313,76 @@ def create_shape(obj: AtomObject, color: AtomColor, position, orientation, size=
         )
     else:
         raise ValueError("Unsupported shape!")
+
+
+class Scene:
+    """
+    Keeps the static fixtures loaded and recycles object bodies between samples, usage:
+    scene = get_scene()
+    scene.place([obj_1, obj_2])
+    """
+
+    HIDDEN_POSITION = (0, 0, -100)
+
+    def __init__(self):
+        reset_env()
+        self.bodies = defaultdict(list)
+        self.colors = {}
+        self.hidden = set()
+
+    def _acquire(self, obj: ObjectOnTable, index: int):
+        pool = self.bodies[(obj.obj_type, obj.size)]
+        if index < len(pool):
+            body = pool[index]
+            pb.resetBasePositionAndOrientation(body, obj.position, pb.getQuaternionFromEuler(obj.orientation))
+            pb.resetBaseVelocity(body, [0, 0, 0], [0, 0, 0])
+            if body in self.hidden:
+                pb.changeDynamics(body, -1, mass=1)
+                self.hidden.remove(body)
+            if self.colors[body] != obj.color:
+                pb.changeVisualShape(body, -1, rgbaColor=obj.color.to_rgba())
+                body_colors[body] = obj.color
+        else:
+            body = create_shape(obj.obj_type, obj.color, obj.position, obj.orientation, obj.size)
+            pool.append(body)
+
+        self.colors[body] = obj.color
+        return body
+
+    def _hide(self, body: int, index: int):
+        if body in self.hidden:
+            return
+        x, y, z = self.HIDDEN_POSITION
+        # static and spread out, so that hidden bodies neither fall nor collide when simulation is stepped
+        pb.changeDynamics(body, -1, mass=0)
+        pb.resetBasePositionAndOrientation(body, [x + 10 * index, y, z], [0, 0, 0, 1])
+        self.hidden.add(body)
+
+    @timed("place")
+    def place(self, objects: Sequence[ObjectOnTable]):
+        used = defaultdict(int)
+        for obj in objects:
+            key = (obj.obj_type, obj.size)
+            obj.shape_id = self._acquire(obj, used[key])
+            used[key] += 1
+
+        hidden = 0
+        for key, pool in self.bodies.items():
+            for body in pool[used[key] :]:
+                self._hide(body, hidden)
+                hidden += 1
+
+
+_scene = None
+
+
+def _invalidate_scene():
+    global _scene
+    _scene = None
+
+
+def get_scene() -> Scene:
+    global _scene
+    if _scene is None:
+        _scene = Scene()
+    return _scene
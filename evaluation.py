@@ -1,27 +1,231 @@
+import glob
+import json
+import os
+import time
+
 import numpy as np
+import tensorflow as tf
 
-from environment import init_env, disconnect_env
+from environment import get_session
+from inference import ProbeScorer
+from network import build_grouped_model
 from predicates import AtomColor, AtomObject, AtomRelation, AtomPredicate
+from predicates import ids_from_one_hot, ids_to_fields, one_hot_from_ids
 from sampling import _VALID_COLORS, _VALID_SHAPES
-from utils import draw_frame, HideOutput
+from utils import draw_frame
 
+# (model, probes, scorer) of the last evaluate_sample call, a scorer splits the model and encodes the probes
+_last_scorer = None
+
+
+def _probe_scorer(model, probes) -> ProbeScorer:
+    global _last_scorer
+    if _last_scorer is None or _last_scorer[0] is not model or not np.array_equal(_last_scorer[1], probes):
+        _last_scorer = model, np.array(probes), ProbeScorer(model, probes)
+    return _last_scorer[2]
 
-def evaluate_sample(sample_func, model=None, probes=None, threshold=0.3, hide_output=True):
 
-    with HideOutput(hide_output):
-        init_env()
-        test_frame, truth = sample_func()
-        disconnect_env()
+def evaluate_sample(sample_func, model=None, probes=None, threshold=0.3, hide_output=True):
+    get_session(hide_output)
+    test_frame, truth = sample_func()
 
     draw_frame(test_frame)
     for p, v in truth:
         print(p, v)
 
     if model:
-        prediction = model.predict((np.broadcast_to(test_frame, (len(probes), *test_frame.shape)), probes,))
+        prediction = _probe_scorer(model, probes).score_frame(test_frame)
 
         print("---")
         for probe, pred in sorted(zip(probes, prediction), key=lambda x: -x[1]):
-            if pred[0] > threshold:
-                print(AtomPredicate.from_one_hot(probe), pred[0])
+            if pred > threshold:
+                print(AtomPredicate.from_one_hot(probe), pred)
+
+
+# groups of the report besides "all": (name, predicate field, enum), the field is the object of the predicate
+_GROUPS = (("relation", 0, AtomRelation), ("object", 1, AtomObject), ("color", 2, AtomColor))
+
+
+class _Accumulator:
+    """
+    Per group logit histograms of the scores of positive and negative predicates (for the AUC),
+    score and target sums per calibration bin and confusion counts at the threshold,
+    the memory does not grow with the data
+    """
+
+    # sigmoid scores pile up close to 0 and 1, so the AUC histogram is uniform in the logit
+    MAX_LOGIT = 16.0
+
+    def __init__(self, num_groups, bins, calibration_bins, threshold):
+        self.num_groups = num_groups
+        self.bins = bins
+        self.calibration_bins = calibration_bins
+        self.threshold = threshold
+        self.positives = np.zeros((num_groups, bins), dtype=np.int64)
+        self.negatives = np.zeros((num_groups, bins), dtype=np.int64)
+        self.counts = np.zeros((num_groups, calibration_bins), dtype=np.int64)
+        self.score_sums = np.zeros((num_groups, calibration_bins))
+        self.target_sums = np.zeros((num_groups, calibration_bins))
+        # [group, label, prediction]
+        self.confusion = np.zeros((num_groups, 2, 2), dtype=np.int64)
+
+    def _cells(self, groups, values, bins):
+        return groups * bins + np.clip((values * bins).astype(np.int64), 0, bins - 1)
+
+    def add(self, groups: np.array, scores: np.array, targets: np.array, labels: np.array):
+        eps = 1.0 / (1.0 + np.exp(self.MAX_LOGIT))
+        clipped = np.clip(scores, eps, 1.0 - eps)
+        logits = (np.log(clipped) - np.log1p(-clipped) + self.MAX_LOGIT) / (2 * self.MAX_LOGIT)
+        cells, size = self._cells(groups, logits, self.bins), (self.num_groups, self.bins)
+        self.positives += np.bincount(cells[labels], minlength=np.prod(size)).reshape(size)
+        self.negatives += np.bincount(cells[~labels], minlength=np.prod(size)).reshape(size)
+
+        cells, size = self._cells(groups, scores, self.calibration_bins), (
+            self.num_groups,
+            self.calibration_bins,
+        )
+        self.counts += np.bincount(cells, minlength=np.prod(size)).reshape(size)
+        self.score_sums += np.bincount(cells, scores, minlength=np.prod(size)).reshape(size)
+        self.target_sums += np.bincount(cells, targets, minlength=np.prod(size)).reshape(size)
+
+        confusion = groups * 4 + labels * 2 + (scores >= self.threshold)
+        self.confusion += np.bincount(confusion, minlength=self.num_groups * 4).reshape(-1, 2, 2)
+
+    def report(self, group: int) -> dict:
+        positives, negatives, counts = self.positives[group], self.negatives[group], self.counts[group]
+        (tn, fp), (fn, tp) = self.confusion[group].tolist()
+        total = int(counts.sum())
+
+        precision = tp / (tp + fp) if tp + fp else None
+        recall = tp / (tp + fn) if tp + fn else None
+        f1 = None
+        if precision is not None and recall is not None:
+            f1 = 2 * precision * recall / (precision + recall) if precision + recall else 0.0
+
+        auc = None
+        if positives.sum() and negatives.sum():
+            # ROC over the bin edges from the highest score down
+            tpr = np.concatenate([[0.0], np.cumsum(positives[::-1]) / positives.sum()])
+            fpr = np.concatenate([[0.0], np.cumsum(negatives[::-1]) / negatives.sum()])
+            auc = float(np.trapz(tpr, fpr))
+
+        filled = counts > 0
+        mean_scores = self.score_sums[group][filled] / counts[filled]
+        mean_targets = self.target_sums[group][filled] / counts[filled]
+        ece = float(np.sum(counts[filled] * np.abs(mean_scores - mean_targets)) / total) if total else None
+
+        return {
+            "count": total,
+            "positives": int(positives.sum()),
+            "tp": tp,
+            "fp": fp,
+            "fn": fn,
+            "tn": tn,
+            "precision": precision,
+            "recall": recall,
+            "f1": f1,
+            "auc": auc,
+            "ece": ece,
+            "calibration": [
+                {
+                    "bin": [b / self.calibration_bins, (b + 1) / self.calibration_bins],
+                    "count": int(c),
+                    "mean_score": s,
+                    "mean_target": t,
+                }
+                for b, c, s, t in zip(np.flatnonzero(filled), counts[filled], mean_scores, mean_targets)
+            ],
+        }
+
+
+def _read_npz(file):
+    with np.load(file) as d:
+        return d["frames"], ids_from_one_hot(d["predicates"]), d["targets"].reshape(d["targets"].shape[:2])
+
+
+def _iter_batches(paths, batch_size):
+    # (uint8 frames, predicate ids, targets) of at most batch_size frames, one dataset file at a time
+    from storage import MANIFEST, iter_chunks, read_manifest
+
+    for path in paths:
+        if os.path.exists(os.path.join(path, MANIFEST)) and read_manifest(path).get("format") == "columnar":
+            chunks = ((c["frames"], c["predicates"], c["targets"]) for c in iter_chunks(path))
+        else:
+            chunks = map(_read_npz, sorted(glob.glob(path + "/*.npz")))
+        for frames, ids, targets in chunks:
+            for i in range(0, len(frames), batch_size):
+                yield frames[i : i + batch_size], ids[i : i + batch_size], targets[i : i + batch_size]
+
+
+def evaluate_dataset(
+    model,
+    paths,
+    batch_size=64,
+    threshold=0.5,
+    label_threshold=0.5,
+    bins=1000,
+    calibration_bins=10,
+    report_path=None,
+) -> dict:
+    """
+    Streams datasets (npz or columnar directories) through the model without plotting and returns a report
+    of confusion counts at `threshold`, precision, recall, histogram AUC and calibration for all predicates
+    and per AtomRelation, AtomObject and AtomColor, which is also written as JSON to `report_path`.
+    A predicate is positive when its target is at least `label_threshold`. Every frame is encoded once.
+    The AUC is computed from histograms of `bins` logit bins, calibration uses `calibration_bins` score bins.
+    """
+    if isinstance(paths, str):
+        paths = [paths]
+
+    grouped_model = build_grouped_model(model)
+    predict = tf.function(lambda frames, index, predicates: grouped_model([frames, index, predicates])[:, 0])
+
+    offsets = np.cumsum([1] + [len(enum.__members__) for _, _, enum in _GROUPS])
+    accumulator = _Accumulator(int(offsets[-1]), bins, calibration_bins, threshold)
+    num_frames = 0
+    start = time.perf_counter()
+
+    for frames, ids, targets in _iter_batches(paths, batch_size):
+        ids, targets = ids.reshape(-1).astype(np.int64), targets.reshape(-1).astype(np.float64)
+        # the last batch of a file is padded to the full batch size, so predict is not retraced for its size
+        padding = batch_size - len(frames)
+        frame_index = np.repeat(np.arange(batch_size, dtype=np.int32), len(ids) // len(frames))
+        padded_ids = np.pad(ids, (0, len(frame_index) - len(ids)))
+        scores = predict(
+            tf.constant(np.pad(frames, ((0, padding), (0, 0), (0, 0), (0, 0))), dtype=tf.float32),
+            frame_index,
+            one_hot_from_ids(padded_ids, np.float32),
+        ).numpy()[: len(ids)]
+
+        fields = ids_to_fields(ids)
+        groups = np.concatenate(
+            [np.zeros(len(ids), dtype=np.int64)]
+            + [offset + fields[:, field] for offset, (_, field, _) in zip(offsets[:-1], _GROUPS)]
+        )
+        accumulator.add(
+            groups,
+            np.tile(scores.astype(np.float64), 4),
+            np.tile(targets, 4),
+            np.tile(targets >= label_threshold, 4),
+        )
+        num_frames += len(frames)
+
+    elapsed = time.perf_counter() - start
+    report = {
+        "paths": list(paths),
+        "num_frames": num_frames,
+        "elapsed_sec": elapsed,
+        "frames_per_sec": num_frames / elapsed if elapsed else 0.0,
+        "threshold": threshold,
+        "label_threshold": label_threshold,
+        "all": accumulator.report(0),
+    }
+    for offset, (name, _, enum) in zip(offsets[:-1], _GROUPS):
+        reports = {member.name: accumulator.report(offset + member.value) for member in enum}
+        report[name] = {member: r for member, r in reports.items() if r["count"]}
 
+    print(f"Evaluated {num_frames} frames at {report['frames_per_sec']:.1f} frames/sec")
+    if report_path:
+        with open(report_path, "w") as f:
+            json.dump(report, f, indent=2)
+    return report
@@ -0,0 +1,263 @@
+"""
+Exports the two-branch models of models/ to TFLite for scoring uint8 frames on the CPU, usage:
+python export.py models/one_object_64input_8_8_16conv_64_128dense.h5 --quantization float16
+python export.py models/one_object_64input_8_8_16conv_64_128dense.h5 --data data/two_objects_dataset_64_test
+The Rescaling(1/255) layer is folded into the first convolution, the drift of the scores against the
+original model and the latency of both at batch sizes 1, 32 and 324 are printed. The exit code is 1 when
+the thresholded scores agree with the original ones on less than --min-agreement of the samples.
+"""
+
+import argparse
+import glob
+import json
+import sys
+import time
+from typing import Optional, Sequence, Tuple
+
+import h5py
+import numpy as np
+import tensorflow as tf
+from tensorflow.keras import layers
+from tensorflow.keras.models import Model
+
+from network import build_model
+from predicates import NUM_PREDICATES, ONE_HOT_SIZE, one_hot_from_ids
+
+QUANTIZATIONS = (None, "float16", "int8")
+
+
+def model_from_weights(path: str, frame_size: Optional[Tuple[int, int]] = None) -> Model:
+    """
+    Builds the model of a weights-only .h5 file, the conv sizes are read from its kernels and the
+    (square) frame size from the input size of the dense layer after the flattened convolutions
+    """
+    with h5py.File(path, "r") as f:
+        kernels = [
+            f[name][weight].shape
+            for name in f.attrs["layer_names"]
+            for weight in f[name].attrs["weight_names"]
+            if weight.endswith("kernel:0")
+        ]
+
+    conv_sizes = [k[-1] for k in kernels if len(k) == 4]
+    if frame_size is None:
+        flat_size = next(k[0] for k in kernels if len(k) == 2 and k[0] != ONE_HOT_SIZE)
+        side = int(round(np.sqrt(flat_size / conv_sizes[-1]))) * 2 ** len(conv_sizes)
+        frame_size = (side, side)
+
+    model = build_model(frame_size, conv_sizes)
+    model.load_weights(path)
+    return model
+
+
+def _frame_shape(model: Model) -> Tuple[int, int, int]:
+    return tuple(next(i for i in model.inputs if len(i.shape) == 4).shape[1:])
+
+
+def fold_rescaling(model: Model) -> Model:
+    # the same model taking uint8 frames, conv(x / 255) == conv'(x) with the kernel of conv' scaled by 1/255
+    rescaling = next(layer for layer in model.layers if isinstance(layer, layers.Rescaling))
+    conv_sizes = [layer.filters for layer in model.layers if isinstance(layer, layers.Conv2D)]
+    folded = build_model(
+        _frame_shape(model)[:2],
+        conv_sizes,
+        model.layers[-1].activation,
+        rescaling=False,
+        frame_dtype="uint8",
+    )
+
+    weighted = [layer for layer in model.layers if layer.weights]
+    folded_weighted = [layer for layer in folded.layers if layer.weights]
+    first_conv = next(layer for layer in weighted if isinstance(layer, layers.Conv2D))
+    for src, dst in zip(weighted, folded_weighted):
+        weights = src.get_weights()
+        if src is first_conv:
+            kernel, bias = weights
+            weights = [kernel * rescaling.scale, bias + rescaling.offset * kernel.sum(axis=(0, 1, 2))]
+        dst.set_weights(weights)
+    return folded
+
+
+def export_tflite(
+    model: Model,
+    path: str,
+    quantization: Optional[str] = None,
+    representative_data: Optional[Tuple[np.array, np.array]] = None,
+) -> bytes:
+    """
+    Converts the folded model to a TFLite flatbuffer and writes it to `path`.
+    quantization="float16" stores float16 weights, "int8" int8 weights with float activations
+    or, with representative (frames, predicates), int8 activations too where the kernels support it
+    """
+    if quantization not in QUANTIZATIONS:
+        raise ValueError(f"Unsupported quantization: {quantization}")
+
+    converter = tf.lite.TFLiteConverter.from_keras_model(model)
+    if quantization:
+        converter.optimizations = [tf.lite.Optimize.DEFAULT]
+    if quantization == "float16":
+        converter.target_spec.supported_types = [tf.float16]
+    if quantization == "int8" and representative_data is not None:
+        # keyed by the input names, the signature does not keep the order of the inputs
+        frame_name, predicate_name = (
+            name for _, name in sorted(zip(model.inputs, model.input_names), key=lambda x: -len(x[0].shape))
+        )
+        frames, predicates = representative_data
+        converter.representative_dataset = lambda: (
+            {frame_name: frames[i : i + 1], predicate_name: predicates[i : i + 1].astype(np.float32)}
+            for i in range(len(frames))
+        )
+
+    content = converter.convert()
+    with open(path, "wb") as f:
+        f.write(content)
+    return content
+
+
+class TFLiteScorer:
+    """
+    Scores (uint8 frames, one-hot predicates) pairs with an exported model, the inputs are resized
+    to the batch size of every call, usage:
+    scorer = TFLiteScorer("model.tflite")
+    scores = scorer.predict(frames, predicates)  # (N,)
+    """
+
+    def __init__(self, path: str, num_threads: Optional[int] = None):
+        self.interpreter = tf.lite.Interpreter(model_path=path, num_threads=num_threads)
+        inputs = self.interpreter.get_input_details()
+        self.frame_input = next(i for i in inputs if len(i["shape"]) == 4)
+        self.predicate_input = next(i for i in inputs if len(i["shape"]) == 2)
+        self.output = self.interpreter.get_output_details()[0]["index"]
+        self.batch_size = None
+
+    def predict(self, frames: np.array, predicates: np.array) -> np.array:
+        if len(frames) != self.batch_size:
+            self.batch_size = len(frames)
+            for i in (self.frame_input, self.predicate_input):
+                self.interpreter.resize_tensor_input(i["index"], [self.batch_size, *i["shape"][1:]])
+            self.interpreter.allocate_tensors()
+
+        self.interpreter.set_tensor(self.frame_input["index"], np.asarray(frames, dtype=np.uint8))
+        self.interpreter.set_tensor(self.predicate_input["index"], np.asarray(predicates, dtype=np.float32))
+        self.interpreter.invoke()
+        return self.interpreter.get_tensor(self.output)[:, 0]
+
+
+def drift(model: Model, scorer: TFLiteScorer, frames: np.array, predicates: np.array, threshold=0.5) -> dict:
+    expected = model.predict([frames.astype(np.float32), predicates], verbose=0)[:, 0]
+    scores = np.concatenate(
+        [scorer.predict(frames[i : i + 256], predicates[i : i + 256]) for i in range(0, len(frames), 256)]
+    )
+    errors = np.abs(scores - expected)
+    return {
+        "num_samples": len(frames),
+        "max_abs_error": float(errors.max()),
+        "mean_abs_error": float(errors.mean()),
+        "agreement": float(np.mean((scores >= threshold) == (expected >= threshold))),
+    }
+
+
+def _best_time(func, repeat):
+    func()
+    best = float("inf")
+    for _ in range(repeat):
+        start = time.perf_counter()
+        func()
+        best = min(best, time.perf_counter() - start)
+    return best
+
+
+def compare_latency(
+    model: Model, scorer: TFLiteScorer, batch_sizes: Sequence[int] = (1, 32, 324), repeat=10
+) -> dict:
+    # best ms per batch and samples/sec of keras predict, a direct keras call and the exported model
+    frame_size = _frame_shape(model)
+    results = {}
+    for batch_size in batch_sizes:
+        frames, predicates = _random_inputs(batch_size, frame_size)
+        float_frames = frames.astype(np.float32)
+        runs = {
+            "keras_predict": lambda: model.predict(
+                [float_frames, predicates], batch_size=batch_size, verbose=0
+            ),
+            "keras_call": lambda: model([float_frames, predicates], training=False),
+            "tflite": lambda: scorer.predict(frames, predicates),
+        }
+        for name, func in runs.items():
+            seconds = _best_time(func, repeat)
+            results[f"{name}.batch_{batch_size}"] = {
+                "ms_per_batch": seconds * 1e3,
+                "samples_per_sec": batch_size / seconds,
+            }
+    return results
+
+
+def _random_inputs(num_samples, frame_size):
+    frames = np.random.randint(256, size=(num_samples, *frame_size), dtype=np.uint8)
+    predicates = one_hot_from_ids(np.random.randint(NUM_PREDICATES, size=num_samples), np.float32)
+    return frames, predicates
+
+
+def _dataset_inputs(path, max_samples):
+    # (frame, predicate) pairs of the first npz files of a dataset
+    frames, predicates = [], []
+    for file in sorted(glob.glob(path + "/*.npz")):
+        data = np.load(file)
+        num_predicates = data["predicates"].shape[1]
+        frames.append(np.repeat(data["frames"], num_predicates, axis=0).astype(np.uint8))
+        predicates.append(data["predicates"].reshape(-1, ONE_HOT_SIZE).astype(np.float32))
+        if sum(len(f) for f in frames) >= max_samples:
+            break
+    return np.concatenate(frames)[:max_samples], np.concatenate(predicates)[:max_samples]
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(
+        description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter
+    )
+    parser.add_argument("weights", help="weights-only .h5 file of models/")
+    parser.add_argument("--output", help="defaults to the weights file with .tflite")
+    parser.add_argument("--quantization", choices=[q for q in QUANTIZATIONS if q])
+    parser.add_argument("--data", help="npz dataset for the drift check and the int8 calibration")
+    parser.add_argument("--samples", type=int, default=1024)
+    parser.add_argument("--batch-sizes", type=int, nargs="+", default=[1, 32, 324])
+    parser.add_argument("--threads", type=int)
+    parser.add_argument("--min-agreement", type=float, default=0.995)
+    args = parser.parse_args(argv)
+
+    model = model_from_weights(args.weights)
+    frames, predicates = (
+        _dataset_inputs(args.data, args.samples)
+        if args.data
+        else _random_inputs(args.samples, _frame_shape(model))
+    )
+
+    output = args.output or args.weights[: -len(".h5")] + ".tflite"
+    export_tflite(
+        fold_rescaling(model),
+        output,
+        args.quantization,
+        (frames[:256], predicates[:256]) if args.data else None,
+    )
+    scorer = TFLiteScorer(output, args.threads)
+
+    report = {
+        "output": output,
+        "quantization": args.quantization,
+        "drift": drift(model, scorer, frames, predicates),
+        "latency": compare_latency(model, scorer, args.batch_sizes),
+    }
+    print(json.dumps(report, indent=2))
+
+    # int8 activations in particular can flip decisions while the mean drift stays small
+    if report["drift"]["agreement"] < args.min_agreement:
+        print(
+            f"WARNING: the exported model agrees with the original on {report['drift']['agreement']:.2%}"
+            f" of the samples, less than --min-agreement {args.min_agreement:.2%}"
+        )
+        return 1
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
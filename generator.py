@@ -6,25 +6,21 @@ from tensorflow import keras
 
 from sampling import sample_one
 from predicates import AtomPredicate
-from environment import init_env, disconnect_env
-from utils import HideOutput
+from environment import get_session
 
 
 def _create_samples_old(num_samples, num_false_predicates, frame_size):
     origin = (0, 0, 0.5)
     bounds = (4.0, 4.0, 0.0)
 
-    with HideOutput():
-        init_env()
-
-        raw_samples = [
-            (frame, p.to_one_hot(), np.array([p_value]))
-            for frame, predicates in [
-                sample_one(origin, bounds, num_false_predicates, 0, frame_size) for i in range(num_samples)
-            ]
-            for p, p_value in predicates
+    get_session()
+    raw_samples = [
+        (frame, p.to_one_hot(), np.array([p_value]))
+        for frame, predicates in [
+            sample_one(origin, bounds, num_false_predicates, 0, frame_size) for i in range(num_samples)
         ]
-        disconnect_env()
+        for p, p_value in predicates
+    ]
 
     random.shuffle(raw_samples)
     return raw_samples
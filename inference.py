@@ -0,0 +1,69 @@
+import numpy as np
+import tensorflow as tf
+from tensorflow import keras
+
+from network import split_model
+
+
+class ProbeScorer:
+    """
+    Splits a two-branch model into a frame encoder and a predicate head, every frame is encoded once
+    and all probes are scored against it in one batched dense computation, usage:
+    scorer = ProbeScorer(model, sampling.get_on_table_probes())
+    scores = scorer.score(frames)  # (frames, probes)
+    """
+
+    def __init__(self, model: keras.Model, probes: np.array):
+        parts = split_model(model)
+        frame_inputs, frame_branch = parts.frame_inputs, parts.frame_branch
+        first, self.head = parts.head[0], parts.head[1:]
+
+        # the first head layer is split into a frame part and a probe part (incl. bias) of the same kernel
+        kernel, bias = first.get_weights()
+        frame_size = frame_branch.shape[-1]
+        frame_kernel, predicate_kernel = (
+            (kernel[:frame_size], kernel[frame_size:])
+            if parts.frame_first
+            else (kernel[-frame_size:], kernel[:-frame_size])
+        )
+
+        self.activation = first.activation
+        self.frame_kernel = tf.constant(frame_kernel)
+        self.encoder = keras.Model(frame_inputs, frame_branch)
+
+        predicate_encoder = keras.Model(parts.predicate_inputs, parts.predicate_branch)
+        self.probes = probes
+        self.probe_part = tf.constant(
+            predicate_encoder(probes.astype(np.float32)).numpy() @ predicate_kernel + bias
+        )
+
+        self._score = tf.function(
+            self._score_batch,
+            input_signature=[tf.TensorSpec((None, *frame_inputs.shape[1:]), tf.float32)],
+        )
+
+    def _score_batch(self, frames):
+        frame_part = tf.matmul(self.encoder(frames, training=False), self.frame_kernel)
+        x = self.activation(frame_part[:, None, :] + self.probe_part[None])
+        for layer in self.head:
+            x = layer(x)
+        return x[..., 0]
+
+    def encode(self, frames: np.array, batch_size=64) -> np.array:
+        return np.concatenate(
+            [
+                self.encoder(frames[i : i + batch_size].astype(np.float32), training=False).numpy()
+                for i in range(0, len(frames), batch_size)
+            ]
+        )
+
+    def score(self, frames: np.array, batch_size=32) -> np.array:
+        return np.concatenate(
+            [
+                self._score(frames[i : i + batch_size].astype(np.float32)).numpy()
+                for i in range(0, len(frames), batch_size)
+            ]
+        )
+
+    def score_frame(self, frame: np.array) -> np.array:
+        return self.score(frame[None])[0]
@@ -0,0 +1,164 @@
+from typing import List, Tuple, Union
+
+import numpy as np
+
+from predicates import AtomColor, AtomObject, AtomPredicate, AtomRelation
+from profiling import timed
+from sampling import _EPS, _TABLE_POSITION_TESTS, SceneBatch, _neighbor_pairs
+
+# order of the last axis of on_table_values, the same as in sampling.get_on_table_relation
+TABLE_RELATIONS = list(_TABLE_POSITION_TESTS.keys())
+
+
+def _norm(x: np.array) -> np.array:
+    # np.linalg.norm of a single (2 or 3 element) vector sums the squares in two interleaved lanes,
+    # the same order is kept here so that the values match the per-object functions bit for bit
+    squares = x * x
+    return np.sqrt(np.sum(squares[..., 0::2], axis=-1) + np.sum(squares[..., 1::2], axis=-1))
+
+
+def on_table_values(scenes: SceneBatch, max_bounds: Union[np.array, float]) -> np.array:
+    max_bounds = np.array(max_bounds, dtype=float)
+    max_bounds[max_bounds == 0] = 1.0
+    norm_pos = scenes.positions / max_bounds
+
+    on_table = np.all(np.abs(norm_pos[..., :2]) < 1.0, axis=-1) & (
+        scenes.positions[..., 2] < scenes.sizes * 0.5 + _EPS
+    )
+    values = {
+        AtomRelation.ON: on_table.astype(float),
+        AtomRelation.ON_LEFT_SIDE_OF: np.clip(-norm_pos[..., 0], 0, 1),
+        AtomRelation.ON_RIGHT_SIDE_OF: np.clip(norm_pos[..., 0], 0, 1),
+        AtomRelation.ON_FAR_SIDE_OF: np.clip(norm_pos[..., 1], 0, 1),
+        AtomRelation.ON_NEAR_SIDE_OF: np.clip(-norm_pos[..., 1], 0, 1),
+        AtomRelation.IN_CENTER_OF: np.clip(1.0 - 1.5 * _norm(norm_pos[..., :2]), 0, 1),
+    }
+    # (scenes, objects, relations)
+    return np.stack([values[relation] for relation in TABLE_RELATIONS], axis=-1)
+
+
+def near_values(scenes: SceneBatch, max_distance=4.0) -> np.array:
+    # (scenes, objects, objects), the diagonal is meaningless
+    distances = _norm(scenes.positions[:, :, None, :] - scenes.positions[:, None, :, :])
+    return np.clip(2.0 * (1.0 - distances / max_distance), 0, 1)
+
+
+def on_values(scenes: SceneBatch) -> np.array:
+    # (scenes, objects, objects), [s, i, j] is True when object i lies on object j
+    positions, sizes = scenes.positions, scenes.sizes
+    sum_sizes = 0.5 * (sizes[:, :, None] + sizes[:, None, :])
+    footprint = _norm(positions[:, :, None, :2] - positions[:, None, :, :2]) - sum_sizes < 0
+    height = (
+        np.abs(positions[:, :, None, 2] - (positions[:, None, :, 2] + sum_sizes)) < sizes[:, :, None] * 0.5
+    )
+
+    on = footprint & height
+    on[:, np.arange(scenes.num_objects), np.arange(scenes.num_objects)] = False
+    return on
+
+
+def near_pairs(scenes: SceneBatch, max_distance=4.0) -> Tuple[np.array, np.array, np.array, np.array]:
+    """
+    Sparse form of near_values: (scene, i, j, value) of the ordered pairs closer than `max_distance`,
+    found per scene with a grid index so that the cost grows with the number of neighbors
+    """
+    s, i, j = _scene_pairs(scenes, max_distance)
+    values = np.clip(
+        2.0 * (1.0 - _norm(scenes.positions[s, i] - scenes.positions[s, j]) / max_distance), 0, 1
+    )
+    keep = values > 0
+    return s[keep], i[keep], j[keep], values[keep]
+
+
+def on_pairs(scenes: SceneBatch) -> Tuple[np.array, np.array, np.array]:
+    # sparse form of on_values: (scene, i, j) of the pairs where object i lies on object j
+    s, i, j = _scene_pairs(scenes, float(scenes.sizes.max(initial=0.0)))
+    positions, sizes = scenes.positions, scenes.sizes
+    sum_sizes = 0.5 * (sizes[s, i] + sizes[s, j])
+    footprint = _norm(positions[s, i, :2] - positions[s, j, :2]) - sum_sizes < 0
+    height = np.abs(positions[s, i, 2] - (positions[s, j, 2] + sum_sizes)) < sizes[s, i] * 0.5
+    on = footprint & height
+    return s[on], i[on], j[on]
+
+
+def _scene_pairs(scenes: SceneBatch, radius: float) -> Tuple[np.array, np.array, np.array]:
+    pairs = [_neighbor_pairs(positions, radius) for positions in scenes.positions]
+    if not pairs:
+        return (np.zeros(0, dtype=np.int64),) * 3
+    s = np.repeat(np.arange(len(pairs)), [len(i) for i, _ in pairs])
+    return s, np.concatenate([i for i, _ in pairs]), np.concatenate([j for _, j in pairs])
+
+
+def _pairs(num_objects: int) -> Tuple[np.array, np.array]:
+    # ordered pairs in the order of itertools.permutations
+    i, j = np.nonzero(~np.eye(num_objects, dtype=bool))
+    return i, j
+
+
+@timed("labeling")
+def label_scenes(
+    scenes: SceneBatch,
+    max_bounds: Union[np.array, float],
+    add_positional=True,
+    near=True,
+    on=True,
+    max_distance=4.0,
+    sparse=False,
+) -> List[List[Tuple[AtomPredicate, float]]]:
+    """
+    Labels all scenes at once, the predicates of every scene are the same and in the same order as
+    get_on_table_relation of each object followed by get_near_relation and get_on_relation.
+    With sparse=True the pairs come from a grid index and the zero NEAR predicates are left out,
+    the same as get_near_relation(..., sparse=True), which scales to scenes with many objects.
+    """
+    table = on_table_values(scenes, max_bounds)
+    if sparse:
+        near_split = _split_pairs(len(scenes), *near_pairs(scenes, max_distance)) if near else None
+        on_split = _split_pairs(len(scenes), *on_pairs(scenes)) if on else None
+    else:
+        i, j = _pairs(scenes.num_objects)
+        near_table = near_values(scenes, max_distance)[:, i, j] if near else None
+        on_table = on_values(scenes)[:, i, j] if on else None
+
+    labels = []
+    for s in range(len(scenes)):
+        types = [AtomObject(t) for t in scenes.types[s]]
+        colors = [AtomColor(c) for c in scenes.colors[s]]
+        preds = []
+
+        for o, (obj, color) in enumerate(zip(types, colors)):
+            values = table[s, o]
+            preds.append(
+                (
+                    AtomPredicate(AtomRelation.ON, obj, color, AtomObject.TABLE, AtomColor.NO_COLOR),
+                    float(values[0]),
+                )
+            )
+            if add_positional and values[0]:
+                preds += [
+                    (AtomPredicate(relation, obj, color, AtomObject.TABLE, AtomColor.NO_COLOR), float(value))
+                    for relation, value in zip(TABLE_RELATIONS[1:], values[1:])
+                ]
+
+        if near:
+            near_scene = near_split[s] if sparse else (i, j, near_table[s])
+            preds += [
+                (AtomPredicate(AtomRelation.NEAR, types[a], colors[a], types[b], colors[b]), value)
+                for a, b, value in zip(*near_scene)
+            ]
+        if on:
+            on_scene = on_split[s] if sparse else (i[on_table[s]], j[on_table[s]])
+            preds += [
+                (AtomPredicate(AtomRelation.ON, types[a], colors[a], types[b], colors[b]), 1.0)
+                for a, b in zip(*on_scene)
+            ]
+
+        labels.append(preds)
+
+    return labels
+
+
+def _split_pairs(num_scenes: int, scene: np.array, *columns: np.array) -> List[Tuple[np.array, ...]]:
+    # the pair columns are ordered by scene, so every scene is a contiguous slice
+    bounds = np.searchsorted(scene, np.arange(num_scenes + 1))
+    return [tuple(c[a:b] for c in columns) for a, b in zip(bounds[:-1], bounds[1:])]
@@ -0,0 +1,97 @@
+from typing import List, NamedTuple, Sequence, Tuple
+
+import tensorflow as tf
+from tensorflow.keras import layers
+from tensorflow.keras.models import Model
+
+from predicates import ONE_HOT_SIZE
+
+PREDICATE_SIZE = ONE_HOT_SIZE
+
+
+def build_model(
+    frame_size: Tuple[int, int],
+    conv_sizes: Sequence[int] = (8, 8, 16),
+    output_activation="sigmoid",
+    rescaling=True,
+    frame_dtype="float32",
+) -> Model:
+    # the two-branch architecture of the notebooks, needed to load the weights stored in models/,
+    # rescaling=False leaves the 1/255 scaling of the frames to the first convolution (see export.py)
+    frame_inputs = layers.Input(shape=(*frame_size, 3), dtype=frame_dtype)
+    x = layers.Rescaling(1.0 / 255.0)(frame_inputs) if rescaling else tf.cast(frame_inputs, tf.float32)
+
+    for size in conv_sizes:
+        x = layers.Conv2D(size, 3, padding="same", activation="relu")(x)
+        x = layers.MaxPooling2D(2, padding="same")(x)
+
+    x = layers.Flatten()(x)
+    conv_branch_outputs = layers.Dense(64, activation="relu")(x)
+
+    predicate_inputs = layers.Input(shape=(PREDICATE_SIZE,))
+    predicate_branch_outputs = layers.Dense(64, activation="relu")(predicate_inputs)
+
+    x = layers.concatenate([conv_branch_outputs, predicate_branch_outputs], axis=-1)
+    x = layers.Dense(128, activation="relu")(x)
+    outputs = layers.Dense(1, activation=output_activation)(x)
+
+    return Model([frame_inputs, predicate_inputs], outputs)
+
+
+class ModelParts(NamedTuple):
+    frame_inputs: tf.Tensor
+    predicate_inputs: tf.Tensor
+    frame_branch: tf.Tensor
+    predicate_branch: tf.Tensor
+    frame_first: bool
+    head: List[layers.Layer]
+
+
+def _depends_on(tensor, inputs) -> bool:
+    try:
+        Model(inputs, tensor)
+        return True
+    except ValueError:
+        return False
+
+
+def split_model(model: Model) -> ModelParts:
+    frame_inputs, predicate_inputs = sorted(model.inputs, key=lambda i: -len(i.shape))
+
+    concat = next(layer for layer in model.layers if isinstance(layer, layers.Concatenate))
+    frame_branch, predicate_branch = concat.input
+    if not _depends_on(frame_branch, frame_inputs):
+        frame_branch, predicate_branch = predicate_branch, frame_branch
+
+    head = model.layers[model.layers.index(concat) + 1 :]
+    if not head or not all(isinstance(layer, layers.Dense) for layer in head):
+        raise ValueError("Unsupported model head, expected dense layers after the branches are merged!")
+
+    return ModelParts(
+        frame_inputs, predicate_inputs, frame_branch, predicate_branch, concat.input[0] is frame_branch, head
+    )
+
+
+def build_grouped_model(model: Model) -> Model:
+    # shares weights with `model`, but encodes every unique frame of a batch only once,
+    # inputs are (frames, frame index per predicate, predicates),
+    # as produced by batching.load_grouped(gather=False)
+    parts = split_model(model)
+
+    frames = layers.Input(shape=parts.frame_inputs.shape[1:])
+    frame_index = layers.Input(shape=(), dtype="int32")
+    predicates = layers.Input(shape=parts.predicate_inputs.shape[1:])
+
+    frame_encoder = Model(parts.frame_inputs, parts.frame_branch)
+    predicate_encoder = Model(parts.predicate_inputs, parts.predicate_branch)
+
+    frame_outputs = tf.gather(frame_encoder(frames), frame_index)
+    predicate_outputs = predicate_encoder(predicates)
+    x = layers.concatenate(
+        [frame_outputs, predicate_outputs] if parts.frame_first else [predicate_outputs, frame_outputs],
+        axis=-1,
+    )
+    for layer in parts.head:
+        x = layer(x)
+
+    return Model([frames, frame_index, predicates], x)
@@ -1,6 +1,8 @@
+from typing import List, Sequence
 import dataclasses
 from dataclasses import dataclass
 from enum import IntEnum
+from functools import lru_cache
 
 import numpy as np
 
@@ -67,10 +69,78 @@ class AtomPredicate:
             "  ", " "
         )
 
+    def to_id(self) -> int:
+        return (
+            self.relation * _STRIDES[0]
+            + self.obj * _STRIDES[1]
+            + self.obj_color * _STRIDES[2]
+            + self.subj * _STRIDES[3]
+            + self.subj_color * _STRIDES[4]
+        )
+
+    def from_id(predicate_id: int) -> "AtomPredicate":
+        return _predicate_table()[predicate_id]
+
     def to_one_hot(self):
-        return np.concatenate([to_one_hot(e) for e in dataclasses.astuple(self)])
+        return _ONE_HOT[self.to_id()].copy()
 
     def from_one_hot(arr: np.array):
-        fields = [f.type for f in dataclasses.fields(AtomPredicate)]
-        indices = np.cumsum([len(e.__members__) for e in fields])
-        return AtomPredicate(*(E(from_one_hot(arr)) for arr, E in zip(np.split(arr, indices), fields)))
+        return AtomPredicate.from_id(int(ids_from_one_hot(arr)))
+
+
+# dense integer ids of all predicates, the fields are digits of a mixed radix number
+_FIELDS = [f.type for f in dataclasses.fields(AtomPredicate)]
+_FIELD_SIZES = [len(e.__members__) for e in _FIELDS]
+_FIELD_OFFSETS = np.cumsum([0] + _FIELD_SIZES[:-1])
+_STRIDES = [int(np.prod(_FIELD_SIZES[i + 1 :])) for i in range(len(_FIELD_SIZES))]
+
+NUM_PREDICATES = int(np.prod(_FIELD_SIZES))
+ONE_HOT_SIZE = sum(_FIELD_SIZES)
+
+
+def ids_to_fields(ids: np.array) -> np.array:
+    return np.stack(np.unravel_index(ids, _FIELD_SIZES), axis=-1)
+
+
+def ids_from_fields(fields: np.array) -> np.array:
+    return (np.asarray(fields) @ np.array(_STRIDES)).astype(np.int16)
+
+
+def _one_hot_table() -> np.array:
+    table = np.zeros((NUM_PREDICATES, ONE_HOT_SIZE))
+    rows = np.arange(NUM_PREDICATES)[:, None]
+    table[rows, _FIELD_OFFSETS + ids_to_fields(rows[:, 0])] = 1.0
+    return table
+
+
+_ONE_HOT = _one_hot_table()
+_ID_WEIGHTS = np.concatenate([np.arange(size) * stride for size, stride in zip(_FIELD_SIZES, _STRIDES)])
+
+
+@lru_cache(maxsize=None)
+def _predicate_table() -> List[AtomPredicate]:
+    return [
+        AtomPredicate(*(E(f) for E, f in zip(_FIELDS, fields)))
+        for fields in ids_to_fields(np.arange(NUM_PREDICATES))
+    ]
+
+
+def encode(predicates: Sequence[AtomPredicate]) -> np.array:
+    fields = np.array(
+        [(p.relation, p.obj, p.obj_color, p.subj, p.subj_color) for p in predicates], dtype=np.int64
+    ).reshape(-1, len(_FIELDS))
+    return ids_from_fields(fields)
+
+
+def decode(ids: np.array) -> List[AtomPredicate]:
+    table = _predicate_table()
+    return [table[i] for i in np.asarray(ids).ravel()]
+
+
+def one_hot_from_ids(ids: np.array, dtype=np.float64) -> np.array:
+    return _ONE_HOT[ids].astype(dtype, copy=False)
+
+
+def ids_from_one_hot(arr: np.array) -> np.array:
+    # every set column of a one-hot row contributes its field value times the field stride
+    return np.rint(np.asarray(arr) @ _ID_WEIGHTS).astype(np.int16)
@@ -0,0 +1,122 @@
+from collections import defaultdict
+from functools import wraps
+import cProfile
+import io
+import json
+import pstats
+import time
+
+
+class StageTimer:
+    """
+    Accumulated wall time and call counts of named stages, cheap enough to stay enabled, usage:
+    with timer.stage("render"):
+        ...
+    Stages may nest, the time of an inner stage is then also part of the outer one.
+    """
+
+    def __init__(self):
+        self.totals = defaultdict(float)
+        self.calls = defaultdict(int)
+        self.counters = defaultdict(int)
+
+    def stage(self, name: str) -> "_Stage":
+        return _Stage(self, name)
+
+    def add(self, name: str, seconds: float, calls=1):
+        self.totals[name] += seconds
+        self.calls[name] += calls
+
+    def count(self, name: str, value=1):
+        self.counters[name] += value
+
+    def snapshot(self) -> dict:
+        return {"totals": dict(self.totals), "calls": dict(self.calls), "counters": dict(self.counters)}
+
+    def merge(self, snapshot: dict):
+        for name, seconds in snapshot["totals"].items():
+            self.add(name, seconds, snapshot["calls"][name])
+        for name, value in snapshot["counters"].items():
+            self.count(name, value)
+
+    def reset(self):
+        self.totals.clear()
+        self.calls.clear()
+        self.counters.clear()
+
+    def postfix(self, num_samples: int, top=4) -> dict:
+        # milliseconds per sample of the most expensive stages, for tqdm.set_postfix
+        if not num_samples:
+            return {}
+        stages = sorted(self.totals.items(), key=lambda x: -x[1])[:top]
+        return {name: f"{seconds / num_samples * 1e3:.1f}ms" for name, seconds in stages}
+
+    def report(self, num_samples: int, elapsed: float) -> dict:
+        return {
+            "num_samples": num_samples,
+            "elapsed_sec": elapsed,
+            "samples_per_sec": num_samples / elapsed if elapsed else 0.0,
+            "stages": {
+                name: {
+                    "total_sec": seconds,
+                    "calls": self.calls[name],
+                    "ms_per_call": seconds / self.calls[name] * 1e3,
+                    "ms_per_sample": seconds / num_samples * 1e3 if num_samples else 0.0,
+                }
+                for name, seconds in sorted(self.totals.items(), key=lambda x: -x[1])
+            },
+            "counters": dict(self.counters),
+        }
+
+    def save(self, path: str, num_samples: int, elapsed: float):
+        with open(path, "w") as f:
+            json.dump(self.report(num_samples, elapsed), f, indent=2)
+
+
+class _Stage:
+    __slots__ = ("timer", "name", "start")
+
+    def __init__(self, timer: StageTimer, name: str):
+        self.timer = timer
+        self.name = name
+
+    def __enter__(self):
+        self.start = time.perf_counter()
+
+    def __exit__(self, exc_type, exc_val, exc_tb):
+        self.timer.add(self.name, time.perf_counter() - self.start)
+
+
+# the timer of this process, pool workers send snapshots of theirs back to the parent
+timer = StageTimer()
+
+
+def timed(name: str):
+    """
+    Decorator that accounts every call of the function to the stage `name` of the process timer
+    """
+
+    def _decorator(func):
+        @wraps(func)
+        def _wrapper(*args, **kwargs):
+            start = time.perf_counter()
+            try:
+                return func(*args, **kwargs)
+            finally:
+                timer.add(name, time.perf_counter() - start)
+
+        return _wrapper
+
+    return _decorator
+
+
+def profile_call(path: str, func, *args, top=20, **kwargs):
+    # runs func under cProfile, dumps the stats to `path` (for snakeviz etc.) and prints the top entries
+    profiler = cProfile.Profile()
+    result = profiler.runcall(func, *args, **kwargs)
+    profiler.dump_stats(path)
+
+    stream = io.StringIO()
+    pstats.Stats(profiler, stream=stream).sort_stats("cumulative").print_stats(top)
+    print(stream.getvalue())
+    return result
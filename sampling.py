@@ -1,5 +1,4 @@
 from typing import Dict, Sequence, Tuple, Union, List, Optional
-import dataclasses
 from dataclasses import dataclass
 from itertools import permutations
 import random
@@ -7,6 +6,8 @@ import random
 import numpy as np
 
 from predicates import AtomColor, AtomObject, AtomPredicate, AtomRelation
+from predicates import ids_from_fields
+from profiling import timed
 
 
 @dataclass
@@ -18,6 +19,7 @@ class ObjectOnTable:
     orientation: np.array
     shape_id: Optional[int] = None
 
+    @timed("layout")
     def sample(
         origin: np.array, max_bounds: Union[np.array, float], max_rotation: float, size: float
     ) -> "ObjectOnTable":
@@ -39,18 +41,150 @@ class ObjectOnTable:
         size: float,
         existing_objects: Sequence["ObjectOnTable"],
         min_distance: float,
+        max_attempts: int = 1000,
     ) -> "ObjectOnTable":
         sample = ObjectOnTable.sample(origin, max_bounds, max_rotation, size)
+        attempts = 1
         while any(ObjectOnTable._has_intersection(sample, o, min_distance) for o in existing_objects):
+            if attempts >= max_attempts:
+                raise ValueError(
+                    f"Could not place an object without intersection in {max_attempts} attempts!"
+                )
             sample = ObjectOnTable.sample(origin, max_bounds, max_rotation, size)
+            attempts += 1
 
         return sample
 
 
+@dataclass
+class SceneBatch:
+    """
+    Struct-of-arrays form of many scenes with the same number of objects:
+    positions/orientations (scenes, objects, 3), sizes/types/colors (scenes, objects)
+    """
+
+    positions: np.array
+    orientations: np.array
+    sizes: np.array
+    types: np.array
+    colors: np.array
+
+    def __len__(self):
+        return len(self.positions)
+
+    @property
+    def num_objects(self) -> int:
+        return self.positions.shape[1]
+
+    def from_objects(scenes: Sequence[Sequence[ObjectOnTable]]) -> "SceneBatch":
+        return SceneBatch(
+            np.array([[o.position for o in scene] for scene in scenes], dtype=float).reshape(
+                len(scenes), -1, 3
+            ),
+            np.array([[o.orientation for o in scene] for scene in scenes], dtype=float).reshape(
+                len(scenes), -1, 3
+            ),
+            np.array([[o.size for o in scene] for scene in scenes], dtype=float).reshape(len(scenes), -1),
+            np.array([[o.obj_type for o in scene] for scene in scenes], dtype=int).reshape(len(scenes), -1),
+            np.array([[o.color for o in scene] for scene in scenes], dtype=int).reshape(len(scenes), -1),
+        )
+
+    def to_objects(self, index: int) -> List[ObjectOnTable]:
+        return [
+            ObjectOnTable(
+                AtomObject(self.types[index, i]),
+                AtomColor(self.colors[index, i]),
+                self.sizes[index, i],
+                self.positions[index, i],
+                self.orientations[index, i],
+            )
+            for i in range(self.num_objects)
+        ]
+
+
 _VALID_SHAPES = {AtomObject.CUBE, AtomObject.SPHERE, AtomObject.PYRAMID}
 _VALID_COLORS = set(AtomColor.__members__.values()) - {AtomColor.NO_COLOR, AtomColor.WHITE}
 
 
+def _place_objects(
+    num_scenes: int,
+    num_objects: int,
+    origin: np.array,
+    max_bounds: Union[np.array, float],
+    min_distance: float,
+    max_attempts: int,
+) -> Tuple[np.array, np.array]:
+    positions = np.zeros((num_scenes, num_objects, 3))
+    placed = np.ones(num_scenes, dtype=bool)
+
+    for k in range(num_objects):
+        pending = np.flatnonzero(placed)
+        for _ in range(max_attempts):
+            candidates = (np.random.random_sample((len(pending), 3)) * 2 - 1) * max_bounds + origin
+            distances = np.linalg.norm(positions[pending, :k] - candidates[:, None, :], axis=-1)
+            accepted = np.all(distances >= min_distance, axis=-1)
+            positions[pending[accepted], k] = candidates[accepted]
+            pending = pending[~accepted]
+            if not len(pending):
+                break
+        placed[pending] = False
+
+    return positions, placed
+
+
+@timed("layout")
+def sample_layouts(
+    num_scenes: int,
+    num_objects: int,
+    origin: np.array,
+    max_bounds: Union[np.array, float],
+    max_rotation: float,
+    size: float,
+    min_distance: float,
+    max_attempts: int = 100,
+    on_failure: str = "resample",
+    max_resamples: int = 10,
+) -> SceneBatch:
+    """
+    Samples many non-intersecting layouts at once, each object is placed by vectorized rejection sampling
+    with at most `max_attempts` candidates per scene. Scenes that could not be placed are either
+    sampled again from scratch (on_failure="resample", at most `max_resamples` times),
+    left out of the result (on_failure="drop") or reported (on_failure="raise") with ValueError.
+    """
+    if on_failure not in ("resample", "drop", "raise"):
+        raise ValueError(f"Unsupported failure policy: {on_failure}")
+
+    positions, placed = _place_objects(
+        num_scenes, num_objects, origin, max_bounds, min_distance, max_attempts
+    )
+    resamples = 0
+    while on_failure == "resample" and not placed.all() and resamples < max_resamples:
+        failed = np.flatnonzero(~placed)
+        positions[failed], placed[failed] = _place_objects(
+            len(failed), num_objects, origin, max_bounds, min_distance, max_attempts
+        )
+        resamples += 1
+
+    if on_failure != "drop" and not placed.all():
+        raise ValueError(
+            f"Could not place {num_objects} objects in {np.sum(~placed)} of {num_scenes} scenes!"
+        )
+
+    num_placed = int(np.sum(placed))
+    shapes, colors = sorted(_VALID_SHAPES), sorted(_VALID_COLORS)
+    orientations = np.zeros((num_placed, num_objects, 3))
+    orientations[..., 2] = np.random.random_sample((num_placed, num_objects)) * max_rotation
+
+    return SceneBatch(
+        positions[placed],
+        orientations,
+        np.full((num_placed, num_objects), float(size)),
+        np.array(shapes)[np.random.randint(len(shapes), size=(num_placed, num_objects))],
+        np.array(colors)[np.random.randint(len(colors), size=(num_placed, num_objects))],
+    )
+
+
+@timed("labeling")
 def get_on_table_relation(
     obj: ObjectOnTable, max_bounds: Union[np.array, float], add_positional=True
 ) -> List[Tuple[AtomPredicate, float]]:
@@ -100,22 +234,77 @@ def _clip(x):
     return np.clip(x, 0, 1)
 
 
+def _neighbor_pairs(points: np.array, radius: float) -> Tuple[np.array, np.array]:
+    """
+    Ordered pairs (i, j), i != j, of the points whose xy distance is below `radius`, in the order of
+    itertools.permutations. The points are hashed to a grid of radius-sized cells and only the 3x3
+    neighborhood of every cell is compared.
+    """
+    num_points = len(points)
+    if num_points < 2 or radius <= 0:
+        return np.zeros(0, dtype=np.int64), np.zeros(0, dtype=np.int64)
+
+    cells = np.floor(points[:, :2] / radius).astype(np.int64)
+    cells -= cells.min(axis=0)
+    # one spare cell on both sides of y, so that the neighbor keys of different columns never collide
+    width = int(cells[:, 1].max()) + 3
+    keys = cells[:, 0] * width + cells[:, 1]
+    order = np.argsort(keys, kind="stable")
+    sorted_keys = keys[order]
+
+    neighbors = keys[:, None] + (np.arange(-1, 2)[:, None] * width + np.arange(-1, 2)).ravel()
+    start = np.searchsorted(sorted_keys, neighbors, side="left").ravel()
+    counts = np.searchsorted(sorted_keys, neighbors, side="right").ravel() - start
+
+    i = np.repeat(np.arange(num_points).repeat(9), counts)
+    j = order[np.repeat(start - np.cumsum(counts) + counts, counts) + np.arange(counts.sum())]
+
+    delta = points[i, :2] - points[j, :2]
+    keep = (i != j) & (np.sum(delta * delta, axis=-1) <= radius * radius)
+    i, j = i[keep], j[keep]
+    pair_order = np.argsort(i * num_points + j)
+    return i[pair_order], j[pair_order]
+
+
+@timed("labeling")
 def get_near_relation(
-    objects: Sequence[ObjectOnTable], max_distance=4.0
+    objects: Sequence[ObjectOnTable], max_distance=4.0, sparse=False
 ) -> List[Tuple[AtomPredicate, float]]:
-    return [
+    """
+    NEAR of all ordered object pairs, with sparse=True only the pairs closer than `max_distance` (those with
+    a non-zero value) are looked up with a grid index and returned
+    """
+    if sparse:
+        pairs = zip(*_neighbor_pairs(np.array([o.position for o in objects]), max_distance))
+    else:
+        pairs = permutations(range(len(objects)), 2)
+
+    preds = [
         (
             AtomPredicate(AtomRelation.NEAR, o1.obj_type, o1.color, o2.obj_type, o2.color),
             np.clip(2.0 * (1.0 - np.linalg.norm(o1.position - o2.position) / max_distance), 0, 1),
         )
-        for o1, o2 in permutations(objects, 2)
+        for o1, o2 in ((objects[a], objects[b]) for a, b in pairs)
     ]
+    return [p for p in preds if p[1] > 0] if sparse else preds
 
 
+# from this many objects on, the candidate pairs of get_on_relation come from the grid index
+_GRID_MIN_OBJECTS = 16
+
+
+@timed("labeling")
 def get_on_relation(objects: Sequence[ObjectOnTable]):
+    if len(objects) >= _GRID_MIN_OBJECTS:
+        # ON needs overlapping footprints, so the xy distance is below the largest object size
+        radius = max(o.size for o in objects)
+        pairs = zip(*_neighbor_pairs(np.array([o.position for o in objects]), radius))
+    else:
+        pairs = permutations(range(len(objects)), 2)
+
     return [
         (AtomPredicate(AtomRelation.ON, o1.obj_type, o1.color, o2.obj_type, o2.color), 1.0)
-        for o1, o2 in permutations(objects, 2)
+        for o1, o2 in ((objects[a], objects[b]) for a, b in pairs)
         if (
             np.linalg.norm(o1.position[:2] - o2.position[:2]) - 0.5 * (o1.size + o2.size) < 0
             and np.abs(o1.position[2] - (o2.position[2] + 0.5 * (o1.size + o2.size))) < o1.size * 0.5
@@ -123,23 +312,67 @@ def get_on_relation(objects: Sequence[ObjectOnTable]):
     ]
 
 
-def _obj_complement(predicate: AtomPredicate) -> List[ObjectOnTable]:
-    return [
-        dataclasses.replace(predicate, obj=o, obj_color=oc)
-        for o in _VALID_SHAPES
-        for oc in _VALID_COLORS
-        if o != predicate.obj or oc != predicate.obj_color
-    ]
+# id offsets of the object (shape, color) fields, so that the false predicates are just integer sums
+_SHAPE_STRIDE, _COLOR_STRIDE = (int(i) for i in ids_from_fields([[0, 1, 0, 0, 0], [0, 0, 1, 0, 0]]))
+_SHAPE_OFFSETS = {o: o * _SHAPE_STRIDE for o in sorted(_VALID_SHAPES)}
+_COLOR_OFFSETS = {oc: oc * _COLOR_STRIDE for oc in sorted(_VALID_COLORS)}
+
+
+def _complement_offsets(obj: AtomObject, obj_color: AtomColor) -> Tuple[List[int], List[int]]:
+    # relative id offsets of the object replacements, split to the same-shape and the other ones
+    base = obj * _SHAPE_STRIDE + obj_color * _COLOR_STRIDE
+    same_shape = (
+        [_SHAPE_OFFSETS[obj] + c - base for oc, c in _COLOR_OFFSETS.items() if oc != obj_color]
+        if obj in _SHAPE_OFFSETS
+        else []
+    )
+    other = [s + c - base for o, s in _SHAPE_OFFSETS.items() if o != obj for c in _COLOR_OFFSETS.values()]
+    return same_shape, other
+
 
+_COMPLEMENT_OFFSETS = {(o, oc): _complement_offsets(o, oc) for o in _SHAPE_OFFSETS for oc in _COLOR_OFFSETS}
 
+
+@timed("false_predicates")
 def get_false_predicates(
-    predicates: Sequence[AtomPredicate], count: int
+    predicates: Sequence[AtomPredicate], count: int, mode="uniform", hard_weight=4.0
 ) -> List[Tuple[AtomPredicate, float]]:
-    p_set = set(next(zip(*predicates)))
-    false_predicates = [
-        (false_p, 0.0) for p, _ in predicates for false_p in _obj_complement(p) if false_p not in p_set
+    """
+    Samples `count` distinct predicates that differ from some given predicate in its object (shape and color)
+    and are not given themselves. They are drawn as integer ids, mode="hard" weights the same-shape,
+    different-color confusions `hard_weight` times more than the others.
+    """
+    if mode not in ("uniform", "hard"):
+        raise ValueError(f"Unsupported false predicate mode: {mode}")
+
+    true_ids = {p.to_id(): p for p, _ in predicates}
+    sources = [
+        (i, *(_COMPLEMENT_OFFSETS.get((p.obj, p.obj_color)) or _complement_offsets(p.obj, p.obj_color)))
+        for i, p in true_ids.items()
     ]
-    return random.sample(false_predicates, count) if count < len(false_predicates) else false_predicates
+
+    chosen = {}
+    for _ in range(10 * count + 50):
+        if len(chosen) >= count:
+            break
+        base, same_shape, other = random.choice(sources)
+        weight = hard_weight if mode == "hard" else 1.0
+        if random.random() * (weight * len(same_shape) + len(other)) < weight * len(same_shape):
+            false_id = base + random.choice(same_shape)
+        else:
+            false_id = base + random.choice(other)
+        if false_id not in true_ids:
+            chosen[false_id] = None
+    else:
+        # too few false predicates to draw them by rejection, all of them are taken
+        candidates = {b + o for b, same_shape, other in sources for o in same_shape + other} - true_ids.keys()
+        if len(candidates) <= count:
+            return [(AtomPredicate.from_id(i), 0.0) for i in sorted(candidates)]
+        chosen.update(
+            (i, None) for i in random.sample(sorted(candidates - chosen.keys()), count - len(chosen))
+        )
+
+    return [(AtomPredicate.from_id(i), 0.0) for i in chosen]
 
 
 def get_on_table_probes(add_positional=True):
@@ -0,0 +1,380 @@
+from typing import Dict, Iterator, List, Tuple
+import glob
+import json
+import os
+
+import numpy as np
+import tensorflow as tf
+
+from predicates import NUM_PREDICATES, ids_from_one_hot, ids_to_fields, one_hot_from_ids
+
+MANIFEST = "manifest.json"
+COLUMNS = ("frames", "predicates", "targets")
+
+
+def _chunk_file(path, chunk, column):
+    return os.path.join(path, f"{chunk}.{column}.npy")
+
+
+def _header_offset(file) -> int:
+    with open(file, "rb") as f:
+        if np.lib.format.read_magic(f) == (1, 0):
+            np.lib.format.read_array_header_1_0(f)
+        else:
+            np.lib.format.read_array_header_2_0(f)
+        return f.tell()
+
+
+class ColumnarWriter:
+    """
+    Writes a dataset as chunks of uint8 frames, int16 predicate ids and float targets,
+    every column of a chunk is a separate .npy file, the manifest is written on close
+    """
+
+    def __init__(self, path: str, targets_dtype=np.float32):
+        os.makedirs(path)
+        self.path = path
+        self.targets_dtype = np.dtype(targets_dtype)
+        self.chunks = []
+        self.columns = None
+
+    def write(self, frames: np.array, predicates: np.array, targets: np.array):
+        chunk = f"_{len(self.chunks):04d}"
+        data = {
+            "frames": np.asarray(frames, dtype=np.uint8),
+            "predicates": ids_from_one_hot(predicates),
+            "targets": np.asarray(targets, dtype=self.targets_dtype).reshape(predicates.shape[:2]),
+        }
+        offsets = {}
+        for column, values in data.items():
+            file = _chunk_file(self.path, chunk, column)
+            np.save(file, values)
+            offsets[column] = _header_offset(file)
+
+        self.columns = {c: {"dtype": v.dtype.str, "shape": list(v.shape[1:])} for c, v in data.items()}
+        self.chunks.append({"name": chunk, "rows": len(frames), "offsets": offsets})
+
+    def close(self):
+        manifest = {
+            "format": "columnar",
+            "version": 1,
+            "num_rows": sum(c["rows"] for c in self.chunks),
+            "columns": self.columns,
+            "chunks": self.chunks,
+        }
+        with open(os.path.join(self.path, MANIFEST), "w") as f:
+            json.dump(manifest, f, indent=2)
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_val, exc_tb):
+        if exc_type is None:
+            self.close()
+
+
+def convert_npz_dataset(src: str, dst: str, targets_dtype=np.float32):
+    with ColumnarWriter(dst, targets_dtype) as writer:
+        for file in sorted(glob.glob(src + "/*.npz")):
+            data = np.load(file)
+            writer.write(data["frames"], data["predicates"], data["targets"])
+
+
+def read_manifest(path: str) -> dict:
+    with open(os.path.join(path, MANIFEST)) as f:
+        return json.load(f)
+
+
+def open_chunk(path: str, chunk: str) -> Dict[str, np.memmap]:
+    return {column: np.load(_chunk_file(path, chunk, column), mmap_mode="r") for column in COLUMNS}
+
+
+def iter_chunks(path: str) -> Iterator[Dict[str, np.memmap]]:
+    for chunk in read_manifest(path)["chunks"]:
+        yield open_chunk(path, chunk["name"])
+
+
+def _rows(frames, predicates, targets, predicate_table):
+    return tf.data.Dataset.from_tensor_slices(
+        (
+            (
+                tf.repeat(frames, tf.shape(targets)[1], axis=0),
+                tf.gather(predicate_table, tf.reshape(predicates, (-1,))),
+            ),
+            tf.reshape(tf.cast(targets, tf.float32), (-1, 1)),
+        )
+    )
+
+
+def load_columnar(path: str) -> tf.data.Dataset:
+    manifest = read_manifest(path)
+    columns = manifest["columns"]
+    predicate_table = tf.constant(one_hot_from_ids(np.arange(NUM_PREDICATES), np.float32))
+
+    chunks = tf.data.Dataset.from_generator(
+        lambda: ((c["frames"], c["predicates"], c["targets"]) for c in iter_chunks(path)),
+        output_signature=tuple(
+            tf.TensorSpec((None, *columns[c]["shape"]), tf.as_dtype(np.dtype(columns[c]["dtype"])))
+            for c in COLUMNS
+        ),
+    )
+    return chunks.flat_map(lambda f, p, t: _rows(f, p, t, predicate_table))
+
+
+def _read_column(file, offset, shape, dtype):
+    data = tf.strings.substr(tf.io.read_file(file), offset, -1)
+    return tf.reshape(tf.io.decode_raw(data, dtype), tf.concat([[-1], shape], axis=0))
+
+
+def _chunk_table(path: str, table: dict):
+    manifest = read_manifest(path)
+    for c in COLUMNS:
+        for chunk in manifest["chunks"]:
+            file = _chunk_file(path, chunk["name"], c)
+            table[c]["files"].append(file)
+            table[c]["offsets"].append(chunk["offsets"][c] if "offsets" in chunk else _header_offset(file))
+            table[c]["shapes"].append(manifest["columns"][c]["shape"])
+        table[c]["dtypes"].add(np.dtype(manifest["columns"][c]["dtype"]))
+    return len(manifest["chunks"])
+
+
+def load_native(
+    paths, shuffle=True, seed=None, num_shards=1, shard_index=0, shuffle_buffer=0, cache=False, prefetch=True
+) -> tf.data.Dataset:
+    """
+    Graph-native loader of columnar datasets, chunks are read and decoded in parallel without py_function.
+    Chunk counts come from the manifests, the chunk order is shuffled deterministically when `seed` is set.
+    """
+    if isinstance(paths, str):
+        paths = [paths]
+
+    table = {c: {"files": [], "offsets": [], "shapes": [], "dtypes": set()} for c in COLUMNS}
+    num_chunks = sum(_chunk_table(path, table) for path in paths)
+    print(f"Datasets contain {num_chunks} chunks in total.")
+
+    if any(len(table[c]["dtypes"]) > 1 for c in COLUMNS):
+        raise ValueError(f"Datasets have incompatible column types: {[table[c]['dtypes'] for c in COLUMNS]}")
+    dtypes = {c: tf.as_dtype(table[c]["dtypes"].pop()) for c in COLUMNS}
+
+    chunks = tf.data.Dataset.from_tensor_slices(
+        tuple((table[c]["files"], table[c]["offsets"], table[c]["shapes"]) for c in COLUMNS)
+    )
+    chunks = chunks.shard(num_shards, shard_index)
+    if shuffle:
+        chunks = chunks.shuffle(num_chunks, seed=seed, reshuffle_each_iteration=True)
+
+    predicate_table = tf.constant(one_hot_from_ids(np.arange(NUM_PREDICATES), np.float32))
+
+    def _read_chunk(frames, predicates, targets):
+        columns = [
+            _read_column(*column, dtypes[c]) for c, column in zip(COLUMNS, (frames, predicates, targets))
+        ]
+        return _rows(*columns, predicate_table)
+
+    rows = chunks.interleave(
+        _read_chunk,
+        cycle_length=tf.data.AUTOTUNE,
+        num_parallel_calls=tf.data.AUTOTUNE,
+        deterministic=seed is not None or not shuffle,
+    )
+    if cache:
+        rows = rows.cache()
+    if shuffle and shuffle_buffer:
+        rows = rows.shuffle(shuffle_buffer, seed=seed)
+    if prefetch:
+        rows = rows.prefetch(tf.data.AUTOTUNE)
+    return rows
+
+
+INDEX = "index.json"
+_INDEX_VERSION = 2
+_ENTRY_DTYPE = np.dtype([("id", "<i2"), ("target", "<f4"), ("file", "<i4"), ("row", "<i4"), ("col", "<i2")])
+# query keywords of the predicate fields, in the order of ids_to_fields
+_QUERY_FIELDS = ("relation", "obj", "obj_color", "subj", "subj_color")
+
+
+def _index_files(path: str) -> Tuple[str, List[str]]:
+    if os.path.exists(os.path.join(path, MANIFEST)) and read_manifest(path).get("format") == "columnar":
+        return "columnar", [chunk["name"] for chunk in read_manifest(path)["chunks"]]
+    return "npz", sorted(os.path.basename(f) for f in glob.glob(path + "/*.npz"))
+
+
+def _read_labels(path: str, format: str, name: str) -> Tuple[np.array, np.array, tuple]:
+    # (predicate ids (N, K), targets (N, K), frame shape) without decoding the frames
+    if format == "columnar":
+        chunk = open_chunk(path, name)
+        return np.asarray(chunk["predicates"]), np.asarray(chunk["targets"]), chunk["frames"].shape[1:]
+
+    data = np.load(os.path.join(path, name))
+    targets = data["targets"]
+    # the frame shape from the header of the member, the frames are not decoded
+    with data.zip.open("frames.npy") as f:
+        if np.lib.format.read_magic(f) == (1, 0):
+            frame_shape = np.lib.format.read_array_header_1_0(f)[0]
+        else:
+            frame_shape = np.lib.format.read_array_header_2_0(f)[0]
+    return ids_from_one_hot(data["predicates"]), targets.reshape(targets.shape[:2]), frame_shape[1:]
+
+
+def _run_file(path: str, run: int, part: str) -> str:
+    return os.path.join(path, f"index.{run:04d}.{part}.npy")
+
+
+def build_index(path: str) -> dict:
+    """
+    Builds or extends the inverted predicate index of a dataset directory (npz or columnar), every
+    (frame, predicate) pair is an entry (predicate id, target, file, row, column). The entries of the files
+    not indexed yet are written as a new run sorted by predicate id, with the offsets of every id, so a call
+    costs only the new files and a query only reads the ranges of the matching ids in every run.
+    """
+    format, names = _index_files(path)
+    index_file = os.path.join(path, INDEX)
+    index = read_index(path) if os.path.exists(index_file) else None
+    if index is None or index.get("version") != _INDEX_VERSION:
+        index = {"format": format, "version": _INDEX_VERSION, "files": [], "frame_shape": None, "runs": []}
+        index["num_entries"] = 0
+
+    entries = []
+    for name in names:
+        if name in index["files"]:
+            continue
+        ids, targets, frame_shape = _read_labels(path, format, name)
+        rows, cols = np.indices(ids.shape)
+        file_entries = np.empty(ids.size, dtype=_ENTRY_DTYPE)
+        file_entries["id"], file_entries["target"] = ids.reshape(-1), targets.reshape(-1)
+        file_entries["file"], file_entries["row"], file_entries["col"] = (
+            len(index["files"]),
+            rows.reshape(-1),
+            cols.reshape(-1),
+        )
+        entries.append(file_entries)
+        index["files"].append(name)
+        index["frame_shape"] = list(frame_shape)
+    if entries:
+        entries = np.concatenate(entries)
+        entries = entries[np.argsort(entries["id"], kind="stable")]
+        run = len(index["runs"])
+        np.save(_run_file(path, run, "entries"), entries)
+        np.save(
+            _run_file(path, run, "offsets"), np.searchsorted(entries["id"], np.arange(NUM_PREDICATES + 1))
+        )
+        index["runs"].append({"run": run, "entries": len(entries)})
+        index["num_entries"] += len(entries)
+
+    # the json is written last, it marks the run as complete
+    with open(index_file + ".tmp", "w") as f:
+        json.dump(index, f, indent=2)
+    os.replace(index_file + ".tmp", index_file)
+    return index
+
+
+def read_index(path: str) -> dict:
+    with open(os.path.join(path, INDEX)) as f:
+        return json.load(f)
+
+
+def _matching_ids(query: dict) -> np.array:
+    # predicate ids whose fields match the query, every field is one value or a collection of values
+    unknown = set(query) - set(_QUERY_FIELDS)
+    if unknown:
+        raise ValueError(f"Unsupported query fields: {unknown}")
+
+    fields = ids_to_fields(np.arange(NUM_PREDICATES))
+    matches = np.ones(NUM_PREDICATES, dtype=bool)
+    for column, name in enumerate(_QUERY_FIELDS):
+        values = query.get(name)
+        if values is not None:
+            matches &= np.isin(fields[:, column], np.atleast_1d(np.array(values, dtype=int)))
+    return np.flatnonzero(matches)
+
+
+class PredicateIndex:
+    """
+    The inverted predicate index of a dataset directory (see build_index), usage:
+    index = PredicateIndex(path)
+    entries = index.lookup(relation=AtomRelation.NEAR, obj=AtomObject.PYRAMID, min_target=0.5)
+    """
+
+    def __init__(self, path: str):
+        self.path = path
+        self.meta = read_index(path)
+        self.runs = [
+            (
+                np.load(_run_file(path, run["run"], "entries"), mmap_mode="r"),
+                np.load(_run_file(path, run["run"], "offsets")),
+            )
+            for run in self.meta["runs"]
+        ]
+
+    def lookup(self, min_target=None, max_target=None, **query) -> np.array:
+        ids = _matching_ids(query)
+        parts = []
+        for entries, offsets in self.runs:
+            # positions of all entries in the [offsets[i], offsets[i + 1]) ranges of the matching ids
+            starts, lengths = offsets[ids], offsets[ids + 1] - offsets[ids]
+            ends = np.cumsum(lengths)
+            positions = np.arange(ends[-1] if len(ends) else 0) + np.repeat(
+                starts - (ends - lengths), lengths
+            )
+            parts.append(entries[positions])
+        entries = np.concatenate(parts) if parts else np.empty(0, dtype=_ENTRY_DTYPE)
+        if min_target is not None:
+            entries = entries[entries["target"] >= min_target]
+        if max_target is not None:
+            entries = entries[entries["target"] <= max_target]
+        return entries
+
+
+def _read_frames(path: str, format: str, name: str, rows: np.array) -> np.array:
+    # columnar chunks are memory mapped, so only the rows are read, npz members are read as a whole
+    if format == "columnar":
+        return np.asarray(open_chunk(path, name)["frames"][rows], dtype=np.uint8)
+    return np.asarray(np.load(os.path.join(path, name))["frames"][rows], dtype=np.uint8)
+
+
+def load_filtered(
+    paths, shuffle=True, seed=None, min_target=None, max_target=None, **query
+) -> tf.data.Dataset:
+    """
+    Streams only the (frame, predicate) pairs of indexed datasets that match the query, e.g.
+    load_filtered(paths, relation=AtomRelation.NEAR, min_target=0.5), as ((uint8 frame, predicate), target).
+    Files without matches are not opened, so the cost follows the size of the subset.
+    """
+    if isinstance(paths, str):
+        paths = [paths]
+
+    indices = [PredicateIndex(path) for path in paths]
+    frame_shapes = {tuple(index.meta["frame_shape"]) for index in indices if index.meta["frame_shape"]}
+    if len(frame_shapes) > 1:
+        raise ValueError(f"Datasets have different frame shapes: {frame_shapes}")
+
+    lookups = []
+    for index in indices:
+        entries = index.lookup(min_target, max_target, **query)
+        for file in np.unique(entries["file"]):
+            lookups.append((index, entries[entries["file"] == file]))
+    print(f"Found {sum(len(e) for _, e in lookups)} matching predicates in {len(lookups)} files.")
+
+    predicate_table = one_hot_from_ids(np.arange(NUM_PREDICATES), np.float32)
+
+    def _generate():
+        rng = np.random.default_rng(seed)
+        for i in rng.permutation(len(lookups)) if shuffle else range(len(lookups)):
+            index, entries = lookups[i]
+            if shuffle:
+                entries = entries[rng.permutation(len(entries))]
+            rows, inverse = np.unique(entries["row"], return_inverse=True)
+            name = index.meta["files"][entries["file"][0]]
+            frames = _read_frames(index.path, index.meta["format"], name, rows)
+            yield frames[inverse], predicate_table[entries["id"]], entries["target"][:, None]
+
+    (frame_shape,) = frame_shapes or {(0, 0, 3)}
+    files = tf.data.Dataset.from_generator(
+        _generate,
+        output_signature=(
+            tf.TensorSpec((None, *frame_shape), tf.uint8),
+            tf.TensorSpec((None, predicate_table.shape[1]), tf.float32),
+            tf.TensorSpec((None, 1), tf.float32),
+        ),
+    )
+    return files.flat_map(lambda f, p, t: tf.data.Dataset.from_tensor_slices(((f, p), t)))
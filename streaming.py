@@ -0,0 +1,232 @@
+from collections import OrderedDict
+import multiprocessing
+import queue
+import traceback
+
+import numpy as np
+import tensorflow as tf
+from tensorflow import keras
+
+from environment import get_session
+from predicates import ONE_HOT_SIZE
+
+
+class _WorkerError:
+    # sent through the queue in place of a sample, the exception itself may not be picklable
+    def __init__(self, worker: int, message: str):
+        self.worker = worker
+        self.message = message
+
+
+def _put(samples, stop, item):
+    while not stop.is_set():
+        try:
+            samples.put(item, timeout=0.1)
+            return
+        except queue.Full:
+            pass
+
+
+def _produce(sample_func, samples, stop, seed, worker, hide_output):
+    from batching import _seed_random, _to_tensor
+
+    try:
+        get_session(hide_output)
+        _seed_random(seed, worker)
+
+        while not stop.is_set():
+            frame, predicates, *_ = sample_func()
+            _put(samples, stop, (np.asarray(frame), *_to_tensor(predicates)))
+    except Exception:
+        _put(samples, stop, _WorkerError(worker, traceback.format_exc()))
+
+
+def _sample_rows(frame, predicates, targets):
+    return tf.data.Dataset.from_tensor_slices(
+        ((tf.repeat(frame[None], tf.shape(targets)[0], axis=0), predicates), targets)
+    )
+
+
+class SampleStream:
+    """
+    Background simulation workers pushing rendered and labeled samples into a bounded queue, usage:
+    with SampleStream(sample_func, num_workers=4) as stream:
+        model.fit(stream.as_tf_dataset().batch(32), steps_per_epoch=100, epochs=10)
+    """
+
+    def __init__(self, sample_func, num_workers=1, queue_size=256, seed=None, hide_output=True):
+        self.sample_func = sample_func
+        self.num_workers = num_workers
+        self.queue_size = queue_size
+        self.seed = seed
+        self.hide_output = hide_output
+        self.workers = []
+
+    def start(self):
+        # without a seed the forked workers would all continue the random state of this process
+        seed = self.seed if self.seed is not None else int(np.random.SeedSequence().entropy)
+        ctx = multiprocessing.get_context("fork")
+        self.samples = ctx.Queue(self.queue_size)
+        self.stop_event = ctx.Event()
+        self.workers = [
+            ctx.Process(
+                target=_produce,
+                args=(self.sample_func, self.samples, self.stop_event, seed, i, self.hide_output),
+                daemon=True,
+            )
+            for i in range(self.num_workers)
+        ]
+        for worker in self.workers:
+            worker.start()
+        return self
+
+    def stop(self):
+        if not self.workers:
+            return
+        self.stop_event.set()
+        for worker in self.workers:
+            worker.join(timeout=5)
+            if worker.is_alive():
+                worker.terminate()
+        self.samples.close()
+        self.workers = []
+
+    def __enter__(self):
+        return self.start()
+
+    def __exit__(self, exc_type, exc_val, exc_tb):
+        self.stop()
+
+    def __iter__(self):
+        # raises when a worker fails or all of them have died, instead of waiting for samples forever
+        while self.workers:
+            try:
+                sample = self.samples.get(timeout=1.0)
+            except queue.Empty:
+                if not any(worker.is_alive() for worker in self.workers):
+                    exit_codes = [worker.exitcode for worker in self.workers]
+                    raise RuntimeError(f"All sample workers died, exit codes: {exit_codes}")
+                continue
+            if isinstance(sample, _WorkerError):
+                raise RuntimeError(f"Sample worker {sample.worker} failed:\n{sample.message}")
+            yield sample
+
+    def as_tf_dataset(self, frame_size) -> tf.data.Dataset:
+        samples = tf.data.Dataset.from_generator(
+            lambda: iter(self),
+            output_signature=(
+                tf.TensorSpec((*frame_size, 3), tf.uint8),
+                tf.TensorSpec((None, ONE_HOT_SIZE), tf.float32),
+                tf.TensorSpec((None, 1), tf.float32),
+            ),
+        )
+        return samples.flat_map(_sample_rows)
+
+
+class StreamingSequence(keras.utils.Sequence):
+    # replaces generator.OneObjectGenerator, batches are taken from a running SampleStream,
+    # so there is no regeneration of the whole epoch at its end
+    def __init__(self, stream: SampleStream, batch_size=32, steps_per_epoch=100):
+        self.stream = stream
+        self.batch_size = batch_size
+        self.steps_per_epoch = steps_per_epoch
+        self.rows = iter(())
+
+    def __len__(self):
+        return self.steps_per_epoch
+
+    def _next_rows(self):
+        frame, predicates, targets = next(iter(self.stream))
+        return ((frame, p, t) for p, t in zip(predicates, targets))
+
+    def __getitem__(self, index):
+        batch = []
+        while len(batch) < self.batch_size:
+            row = next(self.rows, None)
+            if row is None:
+                self.rows = self._next_rows()
+            else:
+                batch.append(row)
+
+        frames, predicates, targets = zip(*batch)
+        return (np.stack(frames, axis=0), np.stack(predicates, axis=0)), np.stack(targets, axis=0)
+
+
+class VirtualDataset:
+    """
+    A procedural dataset of `size` samples that are rendered on demand, sample i is a pure function of
+    (sample_func, seed, i) and the most recently used ones are kept in an LRU cache, usage:
+    dataset = VirtualDataset(sample_func, size=100000, seed=1)
+    frame, predicates, targets = dataset[42]
+    model.fit(dataset.as_tf_dataset(frame_size).batch(32))
+    """
+
+    def __init__(self, sample_func, size: int, seed: int, cache_size=1024, hide_output=True):
+        self.sample_func = sample_func
+        self.size = size
+        self.seed = seed
+        self.cache_size = cache_size
+        self.hide_output = hide_output
+        self.cache = OrderedDict()
+        self.hits = 0
+        self.misses = 0
+
+    def from_dataset(path: str, sample_func, cache_size=1024, hide_output=True) -> "VirtualDataset":
+        # the samples of a dataset written by batching.create_dataset, sample i of shard k is k * batch_size + i
+        from batching import _read_manifest
+
+        manifest = _read_manifest(path)
+        if manifest is None or manifest.get("format") != "npz":
+            raise ValueError(f"{path} has no npz dataset manifest")
+        size = max((shard["index"] + 1 for shard in manifest["shards"]), default=0) * manifest["batch_size"]
+        return VirtualDataset(sample_func, size, manifest["seed"], cache_size, hide_output)
+
+    def __len__(self):
+        return self.size
+
+    def __getitem__(self, index: int):
+        if index < 0:
+            index += self.size
+        if not 0 <= index < self.size:
+            raise IndexError(f"Sample {index} is out of range of {self.size} samples")
+
+        sample = self.cache.get(index)
+        if sample is not None:
+            self.hits += 1
+            self.cache.move_to_end(index)
+            return sample
+
+        self.misses += 1
+        sample = self._generate(index)
+        if self.cache_size:
+            self.cache[index] = sample
+            if len(self.cache) > self.cache_size:
+                self.cache.popitem(last=False)
+        return sample
+
+    def _generate(self, index: int):
+        from batching import generate_sample
+
+        # generate_sample restores the global random state, reading a sample has no side effects on the caller
+        frame, predicates, targets, *_ = generate_sample(self.sample_func, self.seed, index, self.hide_output)
+        return np.asarray(frame, dtype=np.uint8), predicates.astype(np.float32), targets.astype(np.float32)
+
+    def cache_info(self):
+        return {"hits": self.hits, "misses": self.misses, "size": len(self.cache)}
+
+    def as_tf_dataset(self, frame_size, shuffle=True, seed=None) -> tf.data.Dataset:
+        indices = tf.data.Dataset.range(self.size)
+        if shuffle:
+            indices = indices.shuffle(min(self.size, 100000), seed=seed)
+
+        def _load(index):
+            frame, predicates, targets = tf.numpy_function(
+                lambda i: self[int(i)], [index], (tf.uint8, tf.float32, tf.float32)
+            )
+            return (
+                tf.ensure_shape(frame, (*frame_size, 3)),
+                tf.ensure_shape(predicates, (None, ONE_HOT_SIZE)),
+                tf.ensure_shape(targets, (None, 1)),
+            )
+
+        return indices.map(_load).flat_map(_sample_rows)
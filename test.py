@@ -1,25 +1,30 @@
-from typing import List
+from typing import List, Tuple
 import time
 from numpy.core.numeric import ones
 import pybullet as pb
 import numpy as np
-from predicates import AtomColor, AtomObject
+from predicates import AtomColor, AtomObject, AtomPredicate, AtomRelation
 
-from sampling import ObjectOnTable, get_on_table_relation, get_near_relation, get_on_relation
+from sampling import ObjectOnTable, SceneBatch, get_on_table_relation, get_near_relation, get_on_relation
 from environment import init_env, reset_env, create_shape
+from labeling import TABLE_RELATIONS, _norm, on_table_values
 from utils import vec3
 
 threshold = 0.3
 max_bounds = vec3(7.0, 5.0, 0.0)
 
 
-def main():
+def main(continuous=True):
     objects = create_scene()
+    annotator = SceneAnnotator(objects, max_bounds, threshold)
 
     while pb.isConnected():
         pb.stepSimulation()
         time.sleep(1.0 / 240.0)
 
+        if continuous:
+            print_diff(*annotator.update())
+
         key_events = pb.getKeyboardEvents()
 
         # triggered on SPACE key
@@ -59,6 +64,127 @@ def annotate_scene(objects):
             print(f"{r[0]}: {r[1]:.3f}")
 
 
+class SceneAnnotator:
+    """
+    Keeps the relations of a live scene up to date every tick, only the on-table relations of the bodies
+    that moved since the last update and the pairs involving them are recomputed, usage:
+    annotator = SceneAnnotator(objects, max_bounds)
+    appeared, disappeared = annotator.update()  # predicates that crossed the threshold
+    """
+
+    def __init__(
+        self, objects: List[ObjectOnTable], max_bounds, threshold=0.3, max_distance=4.0, tolerance=1e-5
+    ):
+        self.objects = objects
+        self.max_bounds = max_bounds
+        self.threshold = threshold
+        self.max_distance = max_distance
+        self.tolerance = tolerance
+
+        n = len(objects)
+        self.sizes = np.array([o.size for o in objects], dtype=float)
+        self.types = np.array([o.obj_type for o in objects], dtype=int)
+        self.colors = np.array([o.color for o in objects], dtype=int)
+        # nan, so that every body counts as moved in the first update
+        self.positions = np.full((n, 3), np.nan)
+        self.orientations = np.full((n, 3), np.nan)
+        self.table = np.zeros((n, len(TABLE_RELATIONS)))
+        self.near = np.zeros((n, n))
+        self.on = np.zeros((n, n), dtype=bool)
+
+    def _moved(self) -> np.array:
+        for obj in self.objects:
+            _update_position(obj)
+        positions = np.array([o.position for o in self.objects], dtype=float)
+        orientations = np.array([o.orientation for o in self.objects], dtype=float)
+
+        moved = ~(
+            np.all(np.abs(positions - self.positions) <= self.tolerance, axis=-1)
+            & np.all(np.abs(orientations - self.orientations) <= self.tolerance, axis=-1)
+        )
+        self.positions[moved], self.orientations[moved] = positions[moved], orientations[moved]
+        return np.flatnonzero(moved)
+
+    def _table_active(self) -> np.array:
+        # the positional relations only exist for objects on the table, as in get_on_table_relation
+        active = self.table > self.threshold
+        active[:, 1:] &= self.table[:, :1] > 0
+        return active
+
+    def update(self) -> Tuple[List[Tuple[AtomPredicate, float]], List[Tuple[AtomPredicate, float]]]:
+        moved = self._moved()
+        if not len(moved):
+            return [], []
+
+        before = self._table_active(), self.near > self.threshold, self.on.copy()
+        positions, sizes = self.positions, self.sizes
+
+        moved_scene = SceneBatch(
+            positions[moved][None],
+            self.orientations[moved][None],
+            sizes[moved][None],
+            self.types[moved][None],
+            self.colors[moved][None],
+        )
+        self.table[moved] = on_table_values(moved_scene, self.max_bounds)[0]
+
+        # rows of the moved bodies against all bodies, the same formulas as labeling.near_values / on_values
+        distances = _norm(positions[moved][:, None, :] - positions[None, :, :])
+        self.near[moved] = np.clip(2.0 * (1.0 - distances / self.max_distance), 0, 1)
+        self.near[:, moved] = self.near[moved].T
+
+        sum_sizes = 0.5 * (sizes[moved][:, None] + sizes[None, :])
+        footprint = _norm(positions[moved][:, None, :2] - positions[None, :, :2]) - sum_sizes < 0
+        self.on[moved] = footprint & (
+            np.abs(positions[moved][:, None, 2] - (positions[None, :, 2] + sum_sizes))
+            < sizes[moved][:, None] * 0.5
+        )
+        self.on[:, moved] = footprint.T & (
+            np.abs(positions[:, None, 2] - (positions[None, moved, 2] + sum_sizes.T)) < sizes[:, None] * 0.5
+        )
+        self.on[moved, moved] = False
+
+        after = self._table_active(), self.near > self.threshold, self.on
+        appeared, disappeared = [], []
+        for kind, (old, new) in zip(("table", "near", "on"), zip(before, after)):
+            changed = old != new
+            if kind != "table":
+                np.fill_diagonal(changed, False)
+            for i, j in zip(*np.nonzero(changed)):
+                (appeared if new[i, j] else disappeared).append(self._predicate(kind, i, j))
+        return appeared, disappeared
+
+    def _predicate(self, kind, i, j) -> Tuple[AtomPredicate, float]:
+        obj, color = self.objects[i].obj_type, self.objects[i].color
+        if kind == "table":
+            relation = TABLE_RELATIONS[j]
+            return AtomPredicate(relation, obj, color, AtomObject.TABLE, AtomColor.NO_COLOR), self.table[i, j]
+        other = self.objects[j]
+        if kind == "near":
+            return AtomPredicate(AtomRelation.NEAR, obj, color, other.obj_type, other.color), self.near[i, j]
+        return AtomPredicate(AtomRelation.ON, obj, color, other.obj_type, other.color), 1.0
+
+    def predicates(self) -> List[Tuple[AtomPredicate, float]]:
+        # all predicates above the threshold
+        active = self._table_active(), self.near > self.threshold, self.on
+        return [
+            self._predicate(kind, i, j)
+            for kind, mask in zip(("table", "near", "on"), active)
+            for i, j in zip(*np.nonzero(mask))
+            if kind == "table" or i != j
+        ]
+
+
+def print_diff(appeared, disappeared):
+    if not appeared and not disappeared:
+        return
+    print("---")
+    for p, v in appeared:
+        print(f"+ {p}: {v:.3f}")
+    for p, v in disappeared:
+        print(f"- {p}: {v:.3f}")
+
+
 def _update_position(obj):
     pos, q_orient = pb.getBasePositionAndOrientation(obj.shape_id)
     obj.position = np.array(pos)